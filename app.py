@@ -15,55 +15,194 @@
 """
 
 
+import hashlib
+import hmac
+import os
 import pathlib
 from datetime import datetime, timezone
 
-from flask import Flask, render_template, redirect, request, url_for, abort, make_response  # , send_file
+from flask import Flask, Response, render_template, redirect, request, url_for, abort, g, send_file, session, \
+    make_response
 from flask_wtf import CSRFProtect
+from werkzeug.http import is_resource_modified
 
 from urllib import parse
 
-from core import auth, util
-from models import users, pages
+from core import auth, export, metrics, pdf, util
+from models import archive, links, users, pages, schema, search, security
 import settings
 
+
+if settings.METRICS_ENABLED:
+    metrics.instrument(pages, "pages")
+    metrics.instrument(users, "users")
+    metrics.instrument(archive, "archive")
+    metrics.instrument(security, "auth")
+    metrics.instrument(auth, "auth")
+    metrics.instrument(util, "render", ["rest_to_html", "rest_to_html_all"])
+    metrics.instrument(util, "pdf", ["create_pdf", "html_to_pdf"])
+    metrics.instrument(pdf, "pdf", ["get"])
+
+
+def prefetch_user_names(uids):
+    names = g.setdefault("user_names", {})
+    missing = [uid for uid in uids if uid not in names]
+    if len(missing) > 0:
+        names.update(users.to_names(missing))
+
+
+def user_name(uid):
+    prefetch_user_names([uid])
+    return g.user_names[uid]
+
+
 app = Flask(__name__)
-app.config['SECRET_KEY'] = util.random_string()
+app.config['SECRET_KEY'] = settings.SECRET_KEY if settings.SECRET_KEY is not None else util.random_string()
 app.jinja_env.filters["datetime"] = auth.to_local_datetime
-app.jinja_env.filters["user"] = users.to_name
+app.jinja_env.filters["user"] = user_name
 csrf = CSRFProtect(app)
 
+if settings.SECRET_KEY is None:
+    app.logger.warning("SECRET_KEY is not set; sessions are valid only in this process")
+
+_missing_indexes = schema.missing()
+if len(_missing_indexes) > 0:
+    _message = "missing MongoDB indexes: {} (run `python3 -m models.schema`)".format(
+        ", ".join("{}.{}".format(c, n) for c, n in _missing_indexes))
+    if settings.REQUIRE_INDEXES or any(schema.unique(c, n) for c, n in _missing_indexes):
+        raise RuntimeError(_message)
+    app.logger.warning(_message)
+
 
 @app.before_request
 def before_request():
+    if settings.METRICS_ENABLED:
+        metrics.start_request()
     if request.path.startswith("/static"):
         return
     if request.path in [url_for("web_top"), url_for("login")]:
         return
+    if settings.METRICS_ENABLED and request.path == url_for("metrics_page"):
+        # Scrapers do not log in (METRICS_TOKEN protects it)
+        return
     if auth.check():
         return
     return redirect(url_for("web_top"))
 
 
+@app.after_request
+def after_request(response):
+    if settings.METRICS_ENABLED:
+        timings = metrics.finish_request(request.endpoint or "none", response.status_code)
+        if timings is not None and settings.METRICS_SERVER_TIMING:
+            response.headers["Server-Timing"] = metrics.server_timing(timings)
+    return response
+
+
+# (generation of the latest pages, rendered in/sidebar.html)
+_sidebar = (None, None)
+
+
+def sidebar() -> str:
+    global _sidebar
+
+    latests = pages.get_latest()
+    generation = pages.get_latest_generation()
+    cached_generation, html = _sidebar
+    if cached_generation != generation:
+        html = render_template("in/sidebar.html", latests=latests)
+        _sidebar = (generation, html)
+    return html
+
+
 def render(template: str, title: str, **kwargs):
-    return render_template(template, title=title, latests=pages.get_latest(), **kwargs)
+    with metrics.timer("template"):
+        return render_template(template, title=title, sidebar=sidebar(), **kwargs)
+
+
+_system_pages = {}
+
+
+def system_page(path: str, title: str):
+    mtime = pathlib.Path(path).lstat().st_mtime
+    cached = _system_pages.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    with open(path) as fp:
+        data = fp.read()
+    content = {
+        "title": title,
+        "update": {
+            "by": "System",
+            "date": datetime.fromtimestamp(mtime)
+        },
+        "content": util.rest_to_html(data),
+        "noedit": True
+    }
+    _system_pages[path] = (mtime, content)
+    return content
+
+
+def _templates_digest() -> str:
+    # Pages look different when templates or the reST renderer change
+    s256 = hashlib.sha256(util.render_key("").encode("utf-8"))
+    for path in sorted(pathlib.Path(app.root_path, app.template_folder).glob("**/*")):
+        if path.is_file():
+            s256.update(path.read_bytes())
+    return s256.hexdigest()
+
+
+_templates_version = _templates_digest()
+
+
+def etag(*parts) -> str:
+    s256 = hashlib.sha256()
+    for part in parts:
+        s256.update(repr(part).encode("utf-8"))
+        s256.update(b"\0")
+    return s256.hexdigest()
+
+
+def page_validators(last_modified: datetime, *parts):
+    # A page also shows the latest pages and dates in the user's time zone
+    latests = pages.get_latest()
+    if len(latests) > 0:
+        last_modified = max(last_modified, latests[0][pages.UPDATE][pages.DATE])
+    sidebar = [(latest[pages.PAGE_ID], latest[pages.TITLE]) for latest in latests]
+    return etag(_templates_version, auth.get_id(), session.get("timezone"), sidebar, *parts), last_modified
+
+
+def not_modified(tag: str, last_modified: datetime):
+    # Answer conditional requests before loading and rendering the page.
+    # Older Werkzeug parses If-Modified-Since as a naive UTC datetime, so compare naive UTC.
+    naive = last_modified.astimezone(timezone.utc).replace(tzinfo=None)
+    if is_resource_modified(request.environ, tag, last_modified=naive):
+        return None
+    return with_validators(Response(status=304), tag, last_modified)
+
+
+def with_validators(response, tag: str, last_modified: datetime):
+    response = make_response(response)
+    response.set_etag(tag)
+    response.last_modified = last_modified
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route('/')
 def web_top():
     if auth.check():
-        with open(settings.TOP_PAGE_REST) as fp:
-            data = fp.read()
-        content = {
-            "title": "Top Page",
-            "update": {
-                "by": "System",
-                "date": datetime.fromtimestamp(pathlib.Path(settings.TOP_PAGE_REST).lstat().st_mtime)
-            },
-            "content": util.rest_to_html(data),
-            "noedit": True
-        }
-        return render("in/content.html", title="Top", content=content)
+        mtime = datetime.fromtimestamp(pathlib.Path(settings.TOP_PAGE_REST).lstat().st_mtime, timezone.utc)
+        tag, last_modified = page_validators(mtime, "top")
+        response = not_modified(tag, last_modified)
+        if response is not None:
+            return response
+
+        content = system_page(settings.TOP_PAGE_REST, "Top Page")
+        return with_validators(render("in/content.html", title="Top", content=content), tag, last_modified)
     return render_template("out/login.html", title="Sign in")
 
 
@@ -82,11 +221,24 @@ def logout():
 
 @app.route('/contents/<pid>')
 def contents_show(pid):
+    meta = pages.get_meta(pid)
+    if meta is None:
+        abort(404)
+    updated = meta[pages.UPDATE][pages.DATE]
+    backlinks = pages.get_backlinks(pid)
+    tag, last_modified = page_validators(updated, "page", pid, updated, backlinks)
+    response = not_modified(tag, last_modified)
+    if response is not None:
+        return response
+
     page = pages.get(pid)
     if page is None:
         abort(404)
-    page["content"] = util.rest_to_html(page[pages.CONTENT])
-    return render("in/content.html", title=page[pages.TITLE], content=page)
+    updated = page[pages.UPDATE][pages.DATE]
+    tag, last_modified = page_validators(updated, "page", pid, updated, backlinks)
+    page["content"] = pages.render(page)
+    page["backlinks"] = backlinks
+    return with_validators(render("in/content.html", title=page[pages.TITLE], content=page), tag, last_modified)
 
 
 @app.route('/contents/<pid>/edit', methods=["GET", "POST"])
@@ -95,6 +247,7 @@ def contents_edit(pid):
         page = pages.get(pid)
         if page is None:
             abort(404)
+        page.setdefault(pages.VERSION, 0)
         return render("in/edit.html",
                       title="edit {}".format(page[pages.TITLE]),
                       content=page,
@@ -103,43 +256,113 @@ def contents_edit(pid):
     # POST
     title = request.form["title"]
     content = request.form["content"]
+    version = request.form.get("version", type=int)
     user = auth.get_id()
 
-    new_pid = pages.update(pid, user, title, content)
-    if new_pid is not None:
+    page = pages.update(pid, user, title, content, version)
+    if page is not None:
         # Success
-        page = pages.get(new_pid)
-        if page is None:
-            abort(404)
-        return redirect(url_for("contents_show", pid=new_pid))
+        return redirect(url_for("contents_show", pid=page[pages.PAGE_ID]))
 
-    page = pages.get(pid)
+    page = pages.get_meta(pid)
     if page is None:
         abort(404)
+    current_version = page.get(pages.VERSION, 0)
+    if version is not None and version != current_version:
+        message = "This page was updated by {} while you were editing. " \
+                  "Merge your changes into the current page and post again."
+        message = message.format(user_name(page[pages.UPDATE][pages.BY]))
+    else:
+        message = "Already exist"
     return render("in/edit.html",
                   title="edit {}".format(page[pages.TITLE]),
-                  content={"title": title, "content": content},
-                  post_to=url_for("contents_edit", pid=pid))
+                  content={"title": title, "content": content, "version": current_version},
+                  post_to=url_for("contents_edit", pid=pid),
+                  message=message)
+
+
+@app.route('/contents/<pid>/history')
+def contents_history(pid):
+    page = pages.get_meta(pid)
+    if page is None:
+        abort(404)
+
+    before = request.args.get("before")
+    if before is not None:
+        try:
+            before = util.millis_to_datetime(int(before))
+        except ValueError:
+            abort(404)
+
+    history, next_before = archive.get_history(pid, before)
+    prefetch_user_names([revision[archive.PAGE_DATA][pages.UPDATE][pages.BY] for revision in history])
+    if next_before is not None:
+        next_before = util.datetime_to_millis(next_before)
+    return render("in/history.html",
+                  title="history of {}".format(page[pages.TITLE]),
+                  content=page,
+                  history=history,
+                  next_before=next_before)
+
+
+@app.route('/contents/<pid>/history/<aid>')
+def contents_revision(pid, aid):
+    revision = archive.get(aid)
+    if revision is None or revision[archive.PAGE_ID] != pid:
+        abort(404)
+
+    data = revision[archive.PAGE_DATA]
+    content = {
+        "title": data[pages.TITLE],
+        "update": data[pages.UPDATE],
+        "content": util.rest_to_html(data[pages.CONTENT]),
+        "noedit": True
+    }
+    return render("in/content.html", title=data[pages.TITLE], content=content)
 
 
 @app.route('/contents/<pid>/pdf')
 def contents_pdf(pid):
+    meta = pages.get_meta(pid)
+    if meta is None:
+        abort(404)
+    updated = meta[pages.UPDATE][pages.DATE]
+    response = not_modified(etag("pdf", pid, updated, pdf.version(), _templates_version), updated)
+    if response is not None:
+        return response
+
     page = pages.get(pid)
     if page is None:
         abort(404)
 
-    res = make_response(util.create_pdf(page[pages.CONTENT]))
+    path = pdf.get(page[pages.CONTENT])
+    if path is None:
+        abort(503)
+
+    res = send_file(path, mimetype='application/pdf')
     disposition = "attachment; filename*=UTF-8''"
     disposition += parse.quote(page[pages.TITLE] + '.pdf')
     res.headers["Content-Disposition"] = disposition
-    res.mimetype = 'application/pdf'
-    return res
+    updated = page[pages.UPDATE][pages.DATE]
+    return with_validators(res, etag("pdf", pid, updated, pdf.version(), _templates_version), updated)
 
 
 @app.route('/index')
 def index():
-    page_index = pages.get_all_as_index()
-    return render("in/index.html", title="Index", pages=page_index)
+    letters = pages.get_index_letters()
+    letter = request.args.get("letter")
+    if letter is None and len(letters) > 0:
+        letter = letters[0][0]
+
+    after = None
+    if "after" in request.args and "after_id" in request.args:
+        after = (request.args["after"], request.args["after_id"])
+
+    page_index = {}
+    next_page = None
+    if letter is not None:
+        page_index[letter], next_page = pages.get_index_page(letter, after)
+    return render("in/index.html", title="Index", letters=letters, letter=letter, pages=page_index, next_page=next_page)
 
 
 @app.route('/users/new', methods=["GET", "POST"])
@@ -188,9 +411,7 @@ def add_page():
 
     pid = pages.add(title, content, user)
     if pid is not None:
-        page = pages.get(pid)
-        if page is None:
-            abort(404)
+        # Success
         return redirect(url_for("contents_show", pid=pid))
 
     return render("in/edit.html",
@@ -199,43 +420,104 @@ def add_page():
                   post_to=url_for("add_page"), message="Already exist")
 
 
+_SEARCH_PAGE_SIZE = 20
+
+
 @app.route('/search')
 def search_pages():
     start_time = datetime.now(timezone.utc)
-    query = request.args["q"].replace("　", " ")
-    and_q = []
-    or_q = []
-    not_q = []
-    for q in query.split(" "):
-        if q.startswith("-"):
-            not_q.append(q)
-        else:
-            and_q.append(q)
-    result = pages.search(and_q, or_q, not_q)
+    and_q, or_q, not_q = search.parse_query(request.args["q"])
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+
+    result, count = pages.search(and_q, or_q, not_q, (page - 1) * _SEARCH_PAGE_SIZE, _SEARCH_PAGE_SIZE)
     finish_time = datetime.now(timezone.utc)
     time = finish_time - start_time
     return render("in/search_result.html",
                   title="Search",
                   results=result,
-                  count=len(result),
+                  count=count,
+                  page=page,
+                  has_next=page * _SEARCH_PAGE_SIZE < count,
                   time=time.total_seconds(),
                   search_query=request.args["q"])
 
 
+_BROKEN_LINKS_PAGE_SIZE = 100
+
+
+@app.route('/links/broken')
+def broken_links():
+    try:
+        page = max(int(request.args.get("page", 1)), 1)
+    except ValueError:
+        page = 1
+
+    result, count = links.get_broken((page - 1) * _BROKEN_LINKS_PAGE_SIZE, _BROKEN_LINKS_PAGE_SIZE)
+    return render("in/broken_links.html",
+                  title="Broken links",
+                  links=result,
+                  count=count,
+                  page=page,
+                  has_next=page * _BROKEN_LINKS_PAGE_SIZE < count)
+
+
+@app.route('/export', methods=["POST"])
+def export_pages():
+    selection = request.form["selection"]
+    if selection == "ids":
+        value = request.form.getlist("id")
+    else:
+        value = request.form.get("value")
+    job_id = export.submit(auth.get_id(), selection, value, request.form.get("format", "pdf"))
+    if job_id is None:
+        abort(400)
+    return redirect(url_for("export_status", job_id=job_id))
+
+
+def export_job(job_id: str):
+    job = export.get(job_id)
+    if job is None or job[export.BY] != auth.get_id():
+        abort(404)
+    return job
+
+
+@app.route('/export/<job_id>')
+def export_status(job_id):
+    return render("in/export.html", title="Export", job=export_job(job_id))
+
+
+@app.route('/export/<job_id>/download')
+def export_download(job_id):
+    job = export_job(job_id)
+    path = export.path(job)
+    if job[export.STATUS] != export.FINISHED or not os.path.exists(path):
+        abort(404)
+
+    res = send_file(path, mimetype=export.FORMATS[job[export.FORMAT]])
+    res.headers["Content-Disposition"] = "attachment; filename=e97-{}.{}".format(
+        job[export.CREATED].strftime("%Y%m%d-%H%M%S"), job[export.FORMAT])
+    return res
+
+
+@app.route('/metrics')
+def metrics_page():
+    # Plain responses: the HTML error pages need a logged-in session
+    if not settings.METRICS_ENABLED:
+        return Response("Not Found\n", status=404, mimetype="text/plain")
+    if settings.METRICS_TOKEN is not None:
+        expected = "Bearer " + settings.METRICS_TOKEN
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), expected.encode()):
+            return Response("Forbidden\n", status=403, mimetype="text/plain")
+    return metrics.expose(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @app.errorhandler(404)
 def error_handle(error):
     error_page_rest = settings.ERROR_PAGE_DIRECTORY + "/{}.rst".format(error.code)
-    with open(error_page_rest) as fp:
-        data = fp.read()
-    content = {
-        "title": "Error",
-        "update": {
-            "by": "System",
-            "date": datetime.fromtimestamp(pathlib.Path(error_page_rest).lstat().st_mtime)
-        },
-        "content": util.rest_to_html(data),
-        "noedit": True
-    }
+    content = system_page(error_page_rest, "Error")
     return render("in/content.html", title="Error {}".format(error.code), content=content), error.code
 
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+import itertools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import typing
+from datetime import datetime, timezone
+
+import settings
+from models import db
+
+from bench import corpus
+
+
+_QUERIES = [["server"], ["database", "cache"], ["検索"], ["python", "-flask"], ["設定"]]
+_PASSWORD = "benchmark"
+
+
+def __stats(samples: typing.List[float]) -> typing.Dict[str, float]:
+    samples = sorted(samples)
+    return {
+        "n": len(samples),
+        "min": samples[0],
+        "median": statistics.median(samples),
+        "mean": statistics.mean(samples),
+        "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        "max": samples[-1],
+    }
+
+
+def __time(fn: typing.Callable[[int], typing.Any], repeat: int) -> typing.Dict[str, float]:
+    fn(0)
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn(i + 1)
+        samples.append(time.perf_counter() - start)
+    return __stats(samples)
+
+
+def __connect(args):
+    if args.mongo_uri is None:
+        import mongomock
+        db.set_client(mongomock.MongoClient(tz_aware=True))
+    else:
+        settings.MONGO_URI = args.mongo_uri
+    settings.MONGO_DATABASE = args.database
+    db.get_client().drop_database(args.database)
+
+
+def __load(n_pages: int, batch_size=1000):
+    from models import pages, schema, users
+
+    documents = corpus.documents(n_pages)
+    while True:
+        batch = list(itertools.islice(documents, batch_size))
+        if len(batch) == 0:
+            break
+        db.collection("pages").insert_many(batch)
+    for author in corpus.AUTHORS:
+        users.add(author, author.split("@")[0], _PASSWORD, users.LEVEL_WRITER)
+
+    pages.rebuild_search_index()
+    pages.rebuild_title_index()
+    pages.rebuild_links()
+    schema.create()
+
+
+def __split(query: typing.List[str]):
+    return [q for q in query if not q.startswith("-")], [], [q[1:] for q in query if q.startswith("-")]
+
+
+def run(n_pages: int, repeat: int) -> typing.Dict[str, typing.Dict[str, float]]:
+    start = time.perf_counter()
+    __load(n_pages)
+    results = {"load": {"seconds": time.perf_counter() - start}}
+
+    # After loading, so that the app finds the indexes in place.
+    from flask import session
+
+    import app as e97
+    from core import auth, util
+    from models import pages, security
+
+    sample = corpus.content(0, n_pages)
+    sample_id = corpus.title(0)
+    letter = pages.get_index_letters()[0][0]
+
+    results["pages.search"] = __time(lambda i: pages.search(*__split(_QUERIES[i % len(_QUERIES)])), repeat)
+    results["pages.get_latest"] = __time(lambda i: pages.get_latest(), repeat)
+    results["pages.get_all_as_index"] = __time(lambda i: pages.get_all_as_index(), max(1, repeat // 10))
+    results["pages.get_index_page"] = __time(lambda i: pages.get_index_page(letter), repeat)
+
+    with e97.app.test_request_context("/"):
+        # Different content every time to measure docutils, not the render cache.
+        results["util.rest_to_html"] = __time(
+            lambda i: util.rest_to_html(sample + "\n\n.. {} {}\n".format(n_pages, i)), repeat)
+        results["util.rest_to_html (cached)"] = __time(lambda i: util.rest_to_html(sample), repeat)
+
+    results["security.compute_hash"] = __time(lambda i: security.compute_hash(_PASSWORD), repeat)
+
+    with e97.app.test_request_context("/"):
+        auth.login(corpus.AUTHORS[0], "UTC")
+        logged_in = dict(session)
+
+    def check(_):
+        with e97.app.test_request_context("/"):
+            session.update(logged_in)
+            auth.check()
+    results["auth.check"] = __time(check, repeat)
+
+    e97.app.config["WTF_CSRF_ENABLED"] = False
+    client = e97.app.test_client()
+    client.post("/login", data={"email": corpus.AUTHORS[0], "password": _PASSWORD, "tz": "UTC"})
+    for name, url in [
+            ("GET /", "/"),
+            ("GET /contents/<pid>", "/contents/" + sample_id),
+            ("GET /search", "/search?q=server+cache"),
+            ("GET /index", "/index?letter=" + letter)]:
+        status = client.get(url).status_code
+        if status != 200:
+            raise RuntimeError("{} returned {}".format(url, status))
+        results[name] = __time(lambda i: client.get(url), repeat)
+
+    return results
+
+
+def __commit() -> typing.Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark e97 on a synthetic wiki")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="comma separated numbers of pages")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--mongo-uri", help="use this MongoDB instead of mongomock")
+    parser.add_argument("--database", default="e97_bench", help="database to use (dropped before each run)")
+    parser.add_argument("--output", help="write JSON here instead of stdout")
+    args = parser.parse_args()
+
+    report = {
+        "commit": __commit(),
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "mongo": args.mongo_uri or "mongomock",
+        "results": {},
+    }
+    for size in [int(s) for s in args.sizes.split(",")]:
+        __connect(args)
+        report["results"][str(size)] = run(size, args.repeat)
+        print("{} pages done".format(size), file=sys.stderr)
+
+    output = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.output is None:
+        print(output)
+    else:
+        with open(args.output, "w") as fp:
+            fp.write(output)
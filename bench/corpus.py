@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import random
+import typing
+from datetime import datetime, timedelta, timezone
+
+from models import pages
+
+
+WORDS = [
+    "server", "client", "database", "index", "query", "cache", "request", "response", "thread", "process",
+    "deploy", "config", "network", "latency", "storage", "backup", "release", "review", "design", "test",
+    "python", "mongodb", "flask", "docutils", "wiki", "page", "search", "history", "archive", "user",
+]
+
+JAPANESE = [
+    "設定ファイルを更新してからサーバーを再起動します。",
+    "検索結果は更新日時の新しい順に表示されます。",
+    "このページでは開発環境の構築手順を説明します。",
+    "データベースのバックアップは毎日取得しています。",
+    "障害が発生した場合は担当者に連絡してください。",
+    "リリース前にレビューとテストを完了させます。",
+]
+
+AUTHORS = ["alice@example.com", "bob@example.com", "carol@example.com"]
+
+
+def __sentence(rand: random.Random) -> str:
+    if rand.random() < 0.3:
+        return rand.choice(JAPANESE)
+    words = [rand.choice(WORDS) for _ in range(rand.randint(5, 15))]
+    return " ".join(words).capitalize() + "."
+
+
+def __paragraph(rand: random.Random) -> str:
+    return " ".join(__sentence(rand) for _ in range(rand.randint(2, 6)))
+
+
+def title(i: int) -> str:
+    rand = random.Random(i)
+    return "{} {} {}".format(rand.choice(WORDS).capitalize(), rand.choice(WORDS), i)
+
+
+def content(i: int, n_pages: int) -> str:
+    rand = random.Random(i)
+    heading = title(i)
+    parts = [heading, "=" * (len(heading) * 2), ""]
+    for section in range(rand.randint(1, 4)):
+        name = "Section {}".format(section + 1)
+        parts += [name, "-" * len(name), ""]
+        for _ in range(rand.randint(1, 3)):
+            parts += [__paragraph(rand), ""]
+        if rand.random() < 0.5:
+            parts += ["* " + __sentence(rand) for _ in range(rand.randint(2, 5))] + [""]
+        if rand.random() < 0.3:
+            parts += ["::", "", "    $ python3 app.py", "    $ curl http://localhost:5000/", ""]
+    for _ in range(rand.randint(0, 3)):
+        parts += [".. related:: {}".format(title(rand.randrange(n_pages))), ""]
+    return "\n".join(parts)
+
+
+def documents(n_pages: int) -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    start = datetime(2018, 1, 1, tzinfo=timezone.utc)
+    for i in range(n_pages):
+        rand = random.Random(i)
+        created = start + timedelta(minutes=i)
+        updated = created + timedelta(minutes=rand.randint(0, 60 * 24 * 30))
+        page_title = title(i)
+        yield {
+            pages.PAGE_ID: page_title,
+            pages.TITLE: page_title,
+            pages.INITIAL: page_title[:1].upper(),
+            pages.CONTENT: content(i, n_pages),
+            pages.UPDATE: {
+                pages.BY: rand.choice(AUTHORS),
+                pages.DATE: updated
+            },
+            pages.CREATE: {
+                pages.BY: rand.choice(AUTHORS),
+                pages.DATE: created
+            }
+        }
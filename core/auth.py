@@ -19,47 +19,55 @@
 
 
 import datetime
-import os
 import hashlib
+import hmac
+import os
 
-from flask import session
+from flask import session, g
 
-from core import util
+import settings
+from core import session_store, util
 
 _LIMIT = datetime.timedelta(hours=5)
+# Session limit is extended only when it is older than this, so most requests do not rewrite the cookie.
+_EXTEND_INTERVAL = datetime.timedelta(minutes=5)
 _STR_FORMAT = '%Y-%m-%d %H:%M:%S'
-_STRETCHING = 10000
 
-_nonce = {}
+_store = session_store.create(settings.SESSION_STORE)
+
 
+def __token(key: bytes, uid: str) -> str:
+    return hmac.new(key, uid.encode('utf-8'), hashlib.sha256).hexdigest()
 
-def __hash(data):
-    for _ in range(_STRETCHING):
-        s512 = hashlib.sha512()
-        s512.update(data)
-        data = s512.hexdigest().encode('utf-8')
-    return data.decode('utf-8')
+
+def __set_limit() -> datetime.datetime:
+    limit = util.get_current_datetime() + _LIMIT
+    session['limit'] = limit.strftime(_STR_FORMAT)
+    return limit
 
 
 def login(uid, tz_name):
     session['id'] = uid
-    session['limit'] = (util.get_current_datetime() + _LIMIT).strftime(_STR_FORMAT)
+    limit = __set_limit()
     session['timezone'] = tz_name
 
-    nonce = os.urandom(1024)
-    session['nonce'] = __hash(nonce)
-    _nonce[uid] = nonce
+    key = os.urandom(32)
+    session['nonce'] = __token(key, uid)
+    _store.put(uid, key, limit)
+    g.auth_checked = True
     return True
 
 
-def check():
+def __check():
     uid = session.get('id')
     limit = session.get('limit')
     if uid is None or limit is None:
         logout()
         return False
 
-    if uid not in _nonce or session.get('nonce') != __hash(_nonce[uid]):
+    token = session.get('nonce')
+    key = _store.get(uid) if token is not None else None
+    if key is None or not hmac.compare_digest(token, __token(key, uid)):
         return False
 
     dt = util.get_datetime_with_timezone(limit, _STR_FORMAT, datetime.timezone.utc)
@@ -69,7 +77,17 @@ def check():
         logout()
         return False
 
-    return login(uid, session['timezone'])
+    if dt - current < _LIMIT - _EXTEND_INTERVAL:
+        _store.touch(uid, __set_limit())
+    return True
+
+
+def check():
+    checked = g.get('auth_checked')
+    if checked is None:
+        checked = __check()
+        g.auth_checked = checked
+    return checked
 
 
 def logout():
@@ -83,7 +101,8 @@ def logout():
     if session.get('nonce') is not None:
         session.pop('nonce')
         if uid is not None:
-            _nonce.pop(uid)
+            _store.delete(uid)
+    g.auth_checked = False
     return True
 
 
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import threading
+import time
+import typing
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, max_size: int):
+        self.__max_size = max_size
+        self.__data = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.__lock:
+            if key not in self.__data:
+                return default
+            self.__data.move_to_end(key)
+            return self.__data[key]
+
+    def put(self, key, value):
+        if self.__max_size <= 0:
+            return
+        with self.__lock:
+            self.__data[key] = value
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.__max_size:
+                self.__data.popitem(last=False)
+
+    def pop(self, key) -> typing.Any:
+        with self.__lock:
+            return self.__data.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
+
+
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float):
+        self.__ttl = ttl
+        self.__data = LRUCache(max_size)
+
+    def get(self, key, default=None):
+        item = self.__data.get(key)
+        if item is None:
+            return default
+        expire, value = item
+        if expire <= time.monotonic():
+            self.__data.pop(key)
+            return default
+        return value
+
+    def put(self, key, value):
+        if self.__ttl <= 0:
+            return
+        self.__data.put(key, (time.monotonic() + self.__ttl, value))
+
+    def pop(self, key) -> typing.Any:
+        item = self.__data.pop(key)
+        if item is None:
+            return None
+        return item[1]
+
+    def clear(self):
+        self.__data.clear()
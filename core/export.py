@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import logging
+import multiprocessing
+import os
+import threading
+import time
+import typing
+import uuid
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+
+import settings
+from core import pdf, util
+from models import db, pages, search, transfer
+
+
+JOB_ID = "id"
+BY = "by"
+STATUS = "status"
+FORMAT = "format"
+SELECTION = "selection"
+VALUE = "value"
+TOTAL = "total"
+DONE = "done"
+ERROR = "error"
+CREATED = "created"
+EXPIRE = "expire"
+HEARTBEAT = "heartbeat"
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+
+# format -> MIME type
+FORMATS = {
+    "pdf": "application/pdf",
+    "zip": "application/zip",
+}
+# ids (list of page IDs), letter (index letter), search (query) or all
+SELECTIONS = ["ids", "letter", "search", "all"]
+
+"""
+export_jobs
+{
+    "id": JOB_ID,
+    "by": USER_ID,
+    "status": QUEUED, RUNNING, FINISHED or FAILED,
+    "format": "pdf" (pages in one file) or "zip" (a file for each page),
+    "selection": SELECTIONS,
+    "value": page IDs, letter or query,
+    "total": number of pages,
+    "done": number of rendered pages,
+    "error": message (FAILED),
+    "created": datetime,
+    "expire": datetime (removed by TTL index),
+    "heartbeat": datetime, updated while the process which runs the job is alive
+}
+"""
+
+_CHUNK_SIZE = 100
+# Seconds between heartbeats, and without a heartbeat before a queued or running job is failed
+_HEARTBEAT_INTERVAL = 30
+_STALE = 120
+
+__jobs = None
+__processes = None
+# IDs of jobs queued or running in this process
+__active = set()
+__lock = threading.Lock()
+
+
+def __col():
+    return db.collection("export_jobs")
+
+
+def __beat():
+    while True:
+        time.sleep(_HEARTBEAT_INTERVAL)
+        with __lock:
+            active = list(__active)
+        if len(active) == 0:
+            continue
+        try:
+            __col().update_many({JOB_ID: {"$in": active}}, {"$set": {HEARTBEAT: util.get_current_datetime()}})
+        except Exception:
+            logging.getLogger(__name__).exception("export heartbeat failed")
+
+
+def __executors() -> typing.Tuple[ThreadPoolExecutor, ProcessPoolExecutor]:
+    # Created on first use, so that pre-fork servers create them in each worker
+    global __jobs, __processes
+
+    with __lock:
+        if __jobs is None:
+            __jobs = ThreadPoolExecutor(max_workers=1)
+            # Not forked: a fork of this multi-threaded process may copy locks held by other threads
+            __processes = ProcessPoolExecutor(max_workers=settings.EXPORT_PROCESSES,
+                                              mp_context=multiprocessing.get_context("spawn"))
+            threading.Thread(target=__beat, name="export-heartbeat", daemon=True).start()
+        return __jobs, __processes
+
+
+def path(job: typing.Dict[str, typing.Any]) -> str:
+    return os.path.join(settings.EXPORT_DIRECTORY, "{}.{}".format(job[JOB_ID], job[FORMAT]))
+
+
+def __remove_expired():
+    if not os.path.isdir(settings.EXPORT_DIRECTORY):
+        return
+    limit = time.time() - settings.EXPORT_TTL
+    for name in os.listdir(settings.EXPORT_DIRECTORY):
+        file_path = os.path.join(settings.EXPORT_DIRECTORY, name)
+        if os.path.getmtime(file_path) < limit:
+            os.remove(file_path)
+
+
+def submit(by: str, selection: str, value, export_format: str) -> typing.Optional[str]:
+    if selection not in SELECTIONS or export_format not in FORMATS:
+        return None
+
+    __remove_expired()
+    created = util.get_current_datetime()
+    job_id = str(uuid.uuid4())
+    __col().insert_one({
+        JOB_ID: job_id,
+        BY: by,
+        STATUS: QUEUED,
+        FORMAT: export_format,
+        SELECTION: selection,
+        VALUE: value,
+        TOTAL: None,
+        DONE: 0,
+        CREATED: created,
+        EXPIRE: created + timedelta(seconds=settings.EXPORT_TTL),
+        HEARTBEAT: created
+    })
+    jobs, _ = __executors()
+    with __lock:
+        __active.add(job_id)
+    jobs.submit(__run, job_id)
+    return job_id
+
+
+def get(job_id: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    job = __col().find_one({JOB_ID: job_id}, {"_id": False})
+    if job is None or job[STATUS] not in [QUEUED, RUNNING]:
+        return job
+
+    # The process which ran the job has stopped (restarted server)
+    if job.get(HEARTBEAT, job[CREATED]) < util.get_current_datetime() - timedelta(seconds=_STALE):
+        error = "interrupted (the server was stopped)"
+        __col().update_one({JOB_ID: job_id, STATUS: job[STATUS]}, {"$set": {STATUS: FAILED, ERROR: error}})
+        job[STATUS] = FAILED
+        job[ERROR] = error
+    return job
+
+
+def __select(selection: str, value) -> typing.List[str]:
+    if selection == "ids":
+        return list(value)
+    if selection == "letter":
+        pids = []
+        after = None
+        while True:
+            data, after = pages.get_index_page(value, after, 1000)
+            pids.extend(page[pages.PAGE_ID] for page in data)
+            if after is None:
+                return pids
+    if selection == "search":
+        and_query, or_query, not_query = search.parse_query(value)
+        results, _ = pages.search(and_query, or_query, not_query, 0, settings.EXPORT_MAX_PAGES + 1)
+        return [result[pages.PAGE_ID] for result in results]
+    return [page[pages.PAGE_ID] for data in pages.get_all_as_index().values() for page in data]
+
+
+def __chunks(pids: typing.List[str]) -> typing.Iterator[typing.List[typing.Dict[str, typing.Any]]]:
+    for i in range(0, len(pids), _CHUNK_SIZE):
+        chunk = pids[i:i + _CHUNK_SIZE]
+        data = pages.get_many(chunk)
+        yield [data[pid] for pid in chunk if pid in data]
+
+
+def __progress(job_id: str, done: int):
+    __col().update_one({JOB_ID: job_id}, {"$set": {DONE: done}})
+
+
+def __combined(job_id: str, pids: typing.List[str], output: str):
+    _, processes = __executors()
+    html_path = output + ".html"
+    head, tail = util.html_document_parts()
+    done = 0
+    try:
+        with open(html_path, "w", encoding="utf-8") as fp:
+            fp.write(head)
+            for data in __chunks(pids):
+                for body in processes.map(util.rest_to_html, [page[pages.CONTENT] for page in data]):
+                    if done > 0:
+                        fp.write(util.PAGE_BREAK)
+                    fp.write(body)
+                    done += 1
+                __progress(job_id, done)
+            fp.write(tail)
+        util.html_file_to_pdf(html_path, output)
+    finally:
+        if os.path.exists(html_path):
+            os.remove(html_path)
+
+
+def __zip(job_id: str, pids: typing.List[str], output: str):
+    # Reuses PDF files of /contents/<pid>/pdf, and adds new ones to that cache.
+    _, processes = __executors()
+    done = 0
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_STORED) as archive:
+        for data in __chunks(pids):
+            keys = [pdf.cache_key(page[pages.CONTENT]) for page in data]
+            missing = [i for i, key in enumerate(keys) if not pdf.cached(key)]
+            created = processes.map(util.create_pdf, [data[i][pages.CONTENT] for i in missing])
+            for i, content in zip(missing, created):
+                pdf.put(keys[i], content)
+            for page, key in zip(data, keys):
+                archive.write(pdf.cache_path(key), transfer.file_name(page[pages.PAGE_ID]) + ".pdf")
+            done += len(data)
+            __progress(job_id, done)
+
+
+def __run(job_id: str):
+    try:
+        __export(job_id)
+    finally:
+        with __lock:
+            __active.discard(job_id)
+
+
+def __export(job_id: str):
+    job = get(job_id)
+    if job[STATUS] != QUEUED:
+        return
+    try:
+        pids = __select(job[SELECTION], job[VALUE])
+        if len(pids) > settings.EXPORT_MAX_PAGES:
+            message = "{} pages are selected (up to {})".format(len(pids), settings.EXPORT_MAX_PAGES)
+            __col().update_one({JOB_ID: job_id}, {"$set": {STATUS: FAILED, ERROR: message}})
+            return
+        __col().update_one({JOB_ID: job_id}, {"$set": {STATUS: RUNNING, TOTAL: len(pids)}})
+
+        output = path(job)
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+        tmp = "{}.{}.tmp".format(output, uuid.uuid4())
+        try:
+            if job[FORMAT] == "pdf":
+                __combined(job_id, pids, tmp)
+            else:
+                __zip(job_id, pids, tmp)
+            os.replace(tmp, output)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        __col().update_one({JOB_ID: job_id}, {"$set": {STATUS: FINISHED}})
+    except Exception as e:
+        logging.getLogger(__name__).exception("export %s failed", job_id)
+        __col().update_one({JOB_ID: job_id}, {"$set": {STATUS: FAILED, ERROR: str(e)}})
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import bisect
+import contextlib
+import functools
+import inspect
+import threading
+import time
+import typing
+
+from pymongo import monitoring
+
+
+SECONDS_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+_registry = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _labels(names: typing.Sequence[str], values: typing.Sequence[str], extra: str=None) -> str:
+    items = ["{}=\"{}\"".format(n, _escape(str(v))) for n, v in zip(names, values)]
+    if extra is not None:
+        items.append(extra)
+    if len(items) == 0:
+        return ""
+    return "{" + ",".join(items) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str, labels: typing.Sequence[str]=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.__values = {}
+        self.__lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, n: float=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.__lock:
+            self.__values[key] = self.__values.get(key, 0) + n
+
+    def expose(self) -> typing.List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} counter".format(self.name)]
+        with self.__lock:
+            values = sorted(self.__values.items())
+        for key, value in values:
+            lines.append("{}{} {}".format(self.name, _labels(self.labels, key), value))
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, labels: typing.Sequence[str]=(), buckets=SECONDS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (+Inf last), sum]
+        self.__values = {}
+        self.__lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.__lock:
+            item = self.__values.get(key)
+            if item is None:
+                item = self.__values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            item[0][index] += 1
+            item[1] += value
+
+    def expose(self) -> typing.List[str]:
+        lines = ["# HELP {} {}".format(self.name, self.description), "# TYPE {} histogram".format(self.name)]
+        with self.__lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self.__values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = "le=\"{}\"".format(bound)
+                lines.append("{}_bucket{} {}".format(self.name, _labels(self.labels, key, le), cumulative))
+            lines.append("{}_sum{} {}".format(self.name, _labels(self.labels, key), total))
+            lines.append("{}_count{} {}".format(self.name, _labels(self.labels, key), cumulative))
+        return lines
+
+
+REQUEST_SECONDS = Histogram("e97_request_seconds", "Request latency by route.", ["route"])
+REQUESTS = Counter("e97_requests_total", "Requests by route and status code.", ["route", "status"])
+REQUEST_MONGO_COMMANDS = Histogram("e97_request_mongo_commands", "MongoDB round trips per request.",
+                                   ["route"], COUNT_BUCKETS)
+CALL_SECONDS = Histogram("e97_call_seconds", "Time spent in instrumented functions, including callees.",
+                         ["function"])
+MONGO_SECONDS = Histogram("e97_mongo_command_seconds", "MongoDB command latency.", ["command"])
+MONGO_FAILURES = Counter("e97_mongo_command_failures_total", "Failed MongoDB commands.", ["command"])
+
+
+def expose() -> str:
+    lines = []
+    for metric in _registry:
+        lines += metric.expose()
+    return "\n".join(lines) + "\n"
+
+
+# Breakdown of the current request: category -> [exclusive seconds, calls].
+# Time spent in a callee of another category (e.g. MongoDB under pages) is counted only for the callee.
+_local = threading.local()
+
+
+def start_request():
+    _local.breakdown = {}
+    _local.stack = []
+    _local.start = time.perf_counter()
+
+
+def finish_request(route: str, status: int) -> typing.Optional[typing.List[typing.Tuple[str, float, int]]]:
+    breakdown = getattr(_local, "breakdown", None)
+    if breakdown is None:
+        return None
+    elapsed = time.perf_counter() - _local.start
+    _local.breakdown = None
+    _local.stack = None
+
+    REQUEST_SECONDS.observe(elapsed, route=route)
+    REQUESTS.inc(route=route, status=str(status))
+    REQUEST_MONGO_COMMANDS.observe(breakdown.get("db", (0, 0))[1], route=route)
+
+    timings = [(category, seconds, calls) for category, (seconds, calls) in sorted(breakdown.items())]
+    timings.append(("app", max(elapsed - sum(seconds for _, seconds, _ in timings), 0.0), 0))
+    timings.append(("total", elapsed, 0))
+    return timings
+
+
+def server_timing(timings: typing.List[typing.Tuple[str, float, int]]) -> str:
+    items = []
+    for category, seconds, calls in timings:
+        item = "{};dur={:.3f}".format(category, seconds * 1000)
+        if calls > 0:
+            item += ";desc=\"{} call{}\"".format(calls, "" if calls == 1 else "s")
+        items.append(item)
+    return ", ".join(items)
+
+
+def _add(category: str, seconds: float, calls: int=1):
+    item = _local.breakdown.setdefault(category, [0.0, 0])
+    item[0] += seconds
+    item[1] += calls
+
+
+@contextlib.contextmanager
+def timer(category: str, name: typing.Optional[str]=None):
+    stack = getattr(_local, "stack", None)
+    frame = None
+    if stack is not None:
+        frame = [category, 0.0]
+        stack.append(frame)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if name is not None:
+            CALL_SECONDS.observe(elapsed, function=name)
+        if frame is not None and _local.stack is stack:
+            stack.pop()
+            _add(category, elapsed - frame[1])
+            if len(stack) > 0:
+                stack[-1][1] += elapsed
+
+
+def _wrap(fn, category: str, name: str):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with timer(category, name):
+            return fn(*args, **kwargs)
+    wrapper.instrumented = name
+    return wrapper
+
+
+def instrument(module, category: str, names: typing.Optional[typing.Iterable[str]]=None):
+    # Replace public functions of the module, so that calls through the module (pages.get(...)) are timed.
+    if names is None:
+        names = [name for name, value in vars(module).items()
+                 if not name.startswith("_") and inspect.isfunction(value) and value.__module__ == module.__name__]
+    prefix = module.__name__.rsplit(".", 1)[-1]
+    for name in names:
+        fn = getattr(module, name)
+        if hasattr(fn, "instrumented"):
+            continue
+        setattr(module, name, _wrap(fn, category, "{}.{}".format(prefix, name)))
+
+
+class CommandListener(monitoring.CommandListener):
+    # Events are published on the thread which runs the command.
+    @staticmethod
+    def __record(command: str, seconds: float):
+        MONGO_SECONDS.observe(seconds, command=command)
+        stack = getattr(_local, "stack", None)
+        if stack is None:
+            return
+        _add("db", seconds)
+        if len(stack) > 0:
+            stack[-1][1] += seconds
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self.__record(event.command_name, event.duration_micros / 1e6)
+
+    def failed(self, event):
+        MONGO_FAILURES.inc(command=event.command_name)
+        self.__record(event.command_name, event.duration_micros / 1e6)
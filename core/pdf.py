@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+import uuid
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import settings
+from core import util
+
+
+__executor = ThreadPoolExecutor(max_workers=settings.PDF_WORKERS)
+# Running and queued conversions. Requests over this limit are rejected instead of waiting.
+__slots = threading.BoundedSemaphore(settings.PDF_WORKERS + settings.PDF_QUEUE_SIZE)
+__running = {}
+__lock = threading.RLock()
+# Time of the last cleanup of the cache directory (at most once a minute by each process)
+__pruned = 0.0
+_PRUNE_INTERVAL = 60
+
+
+def __css_digest() -> str:
+    with open(util.PDF_CSS, "rb") as fp:
+        return hashlib.sha256(fp.read()).hexdigest()
+
+
+__css = __css_digest()
+
+
+def cache_key(content: str) -> str:
+    s256 = hashlib.sha256()
+    s256.update(__css.encode("utf-8"))
+    s256.update(json.dumps(util.PDF_OPTIONS, sort_keys=True).encode("utf-8"))
+    s256.update(util.render_key(content).encode("utf-8"))
+    return s256.hexdigest()
+
+
+def version() -> str:
+    # Changes when the style or options of PDF files change
+    s256 = hashlib.sha256()
+    s256.update(__css.encode("utf-8"))
+    s256.update(json.dumps(util.PDF_OPTIONS, sort_keys=True).encode("utf-8"))
+    return s256.hexdigest()
+
+
+def cache_path(key: str) -> str:
+    return os.path.join(settings.PDF_CACHE_DIRECTORY, key + ".pdf")
+
+
+def __prune():
+    # Old PDF files are left behind by every edit, so remove unused ones and keep the directory size bounded.
+    global __pruned
+
+    now = time.time()
+    with __lock:
+        if now - __pruned < _PRUNE_INTERVAL:
+            return
+        __pruned = now
+
+    files = []
+    for entry in os.scandir(settings.PDF_CACHE_DIRECTORY):
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith(".tmp"):
+            # Being written, or left by a stopped process
+            if stat.st_mtime < now - settings.PDF_CACHE_TTL:
+                os.remove(entry.path)
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in files:
+        if mtime >= now - settings.PDF_CACHE_TTL and total <= settings.PDF_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def __write(path: str, data: bytes):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, uuid.uuid4())
+    with open(tmp, "wb") as fp:
+        fp.write(data)
+    os.replace(tmp, path)
+    __prune()
+
+
+def cached(key: str) -> bool:
+    # The file exists (and is marked as used, so that it is removed last)
+    try:
+        os.utime(cache_path(key))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def __create(html: str, path: str):
+    __write(path, util.html_to_pdf(html))
+
+
+def put(key: str, data: bytes) -> str:
+    # PDF file generated elsewhere (batch export)
+    path = cache_path(key)
+    __write(path, data)
+    return path
+
+
+def __done(key: str):
+    with __lock:
+        __running.pop(key, None)
+    __slots.release()
+
+
+def get(content: str) -> typing.Optional[str]:
+    key = cache_key(content)
+    path = cache_path(key)
+    if cached(key):
+        return path
+
+    with __lock:
+        future = __running.get(key)
+
+    if future is None:
+        html = util.rest_to_html_all(content)
+        with __lock:
+            future = __running.get(key)
+            if future is None:
+                if not __slots.acquire(blocking=False):
+                    return None
+                future = __executor.submit(__create, html, path)
+                __running[key] = future
+                future.add_done_callback(lambda _: __done(key))
+
+    try:
+        future.result(timeout=settings.PDF_TIMEOUT)
+    except TimeoutError:
+        return None
+    return path
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import datetime
+import threading
+import typing
+
+from core import util
+from models import db
+
+
+USER_ID = "id"
+KEY = "key"
+EXPIRE = "expire"
+
+"""
+sessions
+{
+    "id": USER_ID,
+    "key": session key (bytes),
+    "expire": datetime (removed by TTL index)
+}
+"""
+
+
+class MemoryStore:
+    def __init__(self):
+        self.__data = {}
+        self.__lock = threading.Lock()
+
+    def get(self, uid: str) -> typing.Optional[bytes]:
+        with self.__lock:
+            item = self.__data.get(uid)
+            if item is None:
+                return None
+            key, expire = item
+            if expire <= util.get_current_datetime():
+                self.__data.pop(uid)
+                return None
+            return key
+
+    def put(self, uid: str, key: bytes, expire: datetime.datetime):
+        with self.__lock:
+            self.__data[uid] = (key, expire)
+
+    def touch(self, uid: str, expire: datetime.datetime):
+        with self.__lock:
+            if uid in self.__data:
+                self.__data[uid] = (self.__data[uid][0], expire)
+
+    def delete(self, uid: str):
+        with self.__lock:
+            self.__data.pop(uid, None)
+
+
+class MongoStore:
+    @staticmethod
+    def __col():
+        return db.collection("sessions")
+
+    def get(self, uid: str) -> typing.Optional[bytes]:
+        item = self.__col().find_one({USER_ID: uid, EXPIRE: {"$gt": util.get_current_datetime()}}, {KEY: True})
+        if item is None:
+            return None
+        return bytes(item[KEY])
+
+    def put(self, uid: str, key: bytes, expire: datetime.datetime):
+        self.__col().update_one({USER_ID: uid}, {"$set": {KEY: key, EXPIRE: expire}}, upsert=True)
+
+    def touch(self, uid: str, expire: datetime.datetime):
+        self.__col().update_one({USER_ID: uid}, {"$set": {EXPIRE: expire}})
+
+    def delete(self, uid: str):
+        self.__col().delete_one({USER_ID: uid})
+
+
+STORES = {
+    "memory": MemoryStore,
+    "mongo": MongoStore,
+}
+
+
+def create(name: str):
+    if name not in STORES:
+        raise ValueError("unknown session store: {}".format(name))
+    return STORES[name]()
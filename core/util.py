@@ -18,19 +18,34 @@
 """
 
 
+import re
 import string
+import typing
 import random
+import calendar
 import datetime
+import hashlib
+import io
+from urllib import parse
 
 import pytz
 
 import pdfkit
 
+import docutils
 from docutils import nodes
-from docutils.core import publish_parts
+from docutils.core import publish_doctree, publish_parts
 from docutils.parsers.rst import Directive, directives
 
-from flask import url_for
+from flask import has_app_context, url_for
+
+import settings
+from core import cache
+
+# Increment when a custom directive changes its output to invalidate cached HTML.
+DIRECTIVE_VERSION = 1
+
+__html_cache = cache.LRUCache(settings.RENDER_CACHE_SIZE)
 
 
 def random_string(length=64):
@@ -48,12 +63,45 @@ def get_datetime_with_timezone(time_string, format_string, tz):
     return dt_tz
 
 
+def rest_errors(data: str) -> typing.List[str]:
+    # Errors reported by docutils (rendered as error messages in the page)
+    document = publish_doctree(data, settings_overrides={"report_level": 5, "warning_stream": io.StringIO()})
+    return ["line {}: {}".format(message.get("line"), message.children[0].astext())
+            for message in document.traverse(nodes.system_message) if message["level"] >= 3]
+
+
+def datetime_to_millis(dt: datetime.datetime) -> int:
+    return calendar.timegm(dt.utctimetuple()) * 1000 + dt.microsecond // 1000
+
+
+def millis_to_datetime(millis: int) -> datetime.datetime:
+    dt = datetime.datetime.fromtimestamp(millis // 1000, tz=datetime.timezone.utc)
+    return dt + datetime.timedelta(milliseconds=millis % 1000)
+
+
 def rest_to_html_all(data: str) -> str:
     return publish_parts(data, writer_name="html")["whole"]
 
 
-def rest_to_html(data: str) -> str:
-    return publish_parts(data, writer_name="html")["html_body"]
+def render_key(data: str) -> str:
+    s256 = hashlib.sha256()
+    s256.update("{}:{}:".format(docutils.__version__, DIRECTIVE_VERSION).encode("utf-8"))
+    s256.update(data.encode("utf-8"))
+    return s256.hexdigest()
+
+
+def rest_to_html(data: str, key: typing.Optional[str]=None) -> str:
+    if key is None:
+        key = render_key(data)
+    html = __html_cache.get(key)
+    if html is None:
+        html = publish_parts(data, writer_name="html")["html_body"]
+        __html_cache.put(key, html)
+    return html
+
+
+def forget_html(key: str):
+    __html_cache.pop(key)
 
 
 def datetime_local_as_datetime(dt: datetime.datetime, timezone):
@@ -62,23 +110,78 @@ def datetime_local_as_datetime(dt: datetime.datetime, timezone):
     return dt.astimezone(pytz.timezone(timezone))
 
 
+PDF_CSS = "static/common.css"
+PDF_OPTIONS = {
+    "encoding": "UTF-8",
+    "page-size": "A4",
+    'margin-top': '0in',
+    'margin-right': '0in',
+    'margin-bottom': '0in',
+    'margin-left': '0in',
+}
+
+
 def create_pdf(content: str):
-    html = rest_to_html_all(content)
+    return html_to_pdf(rest_to_html_all(content))
+
+
+def html_to_pdf(html: str):
     return pdfkit.from_string(
         input=html,
         output_path=False,
-        css="static/common.css",
-        options={
-            "encoding": "UTF-8",
-            "page-size": "A4",
-            'margin-top': '0in',
-            'margin-right': '0in',
-            'margin-bottom': '0in',
-            'margin-left': '0in',
-        }
+        css=PDF_CSS,
+        options=PDF_OPTIONS
+    )
+
+
+def html_file_to_pdf(html_path: str, pdf_path: str):
+    pdfkit.from_file(
+        input=html_path,
+        output_path=pdf_path,
+        css=PDF_CSS,
+        options=PDF_OPTIONS
     )
 
 
+# Same as the page-break directive
+PAGE_BREAK = '<p class="page-break"></p>\n'
+
+
+def html_document_parts() -> typing.Tuple[str, str]:
+    # Beginning and end of an HTML document (with the docutils stylesheet) around rest_to_html() results
+    parts = publish_parts("", writer_name="html")
+    return parts["head_prefix"] + parts["head"] + parts["stylesheet"] + parts["body_prefix"], parts["body_suffix"]
+
+
+def contents_url(pid: str) -> str:
+    # url_for needs an application context, which command line tools and worker processes do not have.
+    if has_app_context():
+        return url_for("contents_show", pid=pid)
+    return "/contents/" + parse.quote(pid, safe="")
+
+
+# Quick check before parsing: most pages have no related directive
+_RELATED = re.compile(r"related\s*::", re.IGNORECASE)
+# Attribute of the nodes created by related directives (not written to HTML)
+_RELATED_TARGET = "related_target"
+
+
+def related_targets(data: str) -> typing.List[str]:
+    # Page IDs given to related directives which are rendered (not those in literal blocks or comments),
+    # for the link graph
+    if _RELATED.search(data) is None:
+        return []
+    document = publish_doctree(data, settings_overrides={"report_level": 5, "warning_stream": io.StringIO()})
+    targets = []
+    for node in document.traverse(nodes.inline):
+        target = node.get(_RELATED_TARGET)
+        if target is None or isinstance(node.parent, nodes.substitution_definition):
+            continue
+        if target not in targets:
+            targets.append(target)
+    return targets
+
+
 class RelatedDirective(Directive):
     required_arguments = 1
     optional_arguments = 0
@@ -89,13 +192,14 @@ class RelatedDirective(Directive):
     def run(self):
         q = self.arguments[0]
         title = q
-        refuri = url_for("contents_show", pid=q)
+        refuri = contents_url(q)
         self.options['refuri'] = refuri
         self.options['name'] = title
         ref_node = nodes.reference(**self.options)
         ref_node += nodes.Text(title)
 
         node = nodes.inline()
+        node[_RELATED_TARGET] = q
         node += ref_node
         return [node]
 
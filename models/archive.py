@@ -17,56 +17,285 @@
    limitations under the License.
 """
 
+import difflib
+import json
 import typing
+import zlib
 from datetime import datetime, timezone
 import uuid
 
 import pymongo
+from pymongo.errors import DuplicateKeyError
 
+import settings
+from models import db
 
-__client = pymongo.MongoClient(tz_aware=True)
-__db = __client["e97"]
-__col = __db["archive"]
+
+def __col(secondary=False):
+    return db.collection("archive", secondary)
 
 
 ARCHIVE_ID = "id"
 ARCHIVED_DATE = "date"
 PAGE_DATA = "data"
 PAGE_ID = "page_id"
+REVISION = "revision"
+BASE = "base"
+CONTENT = "content"
+SIZE = "size"
 
 """
 {
     "id": ARCHIVE_ID,
     "date": datetime,
-    "data": {PAGE_DATA},
-    "page_id": PAGE_ID
+    "data": {PAGE_DATA without content},
+    "page_id": PAGE_ID,
+    "revision": 0, 1, 2, ...,
+    "base": REVISION of keyframe (same as "revision" if this is keyframe),
+    "content": compressed content (keyframe) or compressed diff from keyframe,
+    "size": length of content
 }
+
+Archives saved by older versions have no "revision" and keep the whole page in "data".
 """
 
 
-def add(data: typing.Dict[str, typing.Any]):
+def __compress(obj) -> bytes:
+    return zlib.compress(json.dumps(obj, ensure_ascii=False).encode("utf-8"))
+
+
+def __decompress(data: bytes):
+    return json.loads(zlib.decompress(data).decode("utf-8"))
+
+
+def __diff(base: str, content: str) -> typing.List[typing.Union[typing.List[int], str]]:
+    # [start, end] copies lines of base, str inserts text
+    base_lines = base.splitlines(keepends=True)
+    lines = content.splitlines(keepends=True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, base_lines, lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == "equal":
+            ops.append([i1, i2])
+        elif j1 < j2:
+            ops.append("".join(lines[j1:j2]))
+    return ops
+
+
+def __patch(base: str, ops: typing.List[typing.Union[typing.List[int], str]]) -> str:
+    base_lines = base.splitlines(keepends=True)
+    return "".join("".join(base_lines[op[0]:op[1]]) if isinstance(op, list) else op for op in ops)
+
+
+def __encode(
+        data: typing.Dict[str, typing.Any],
+        revision: int,
+        keyframe: typing.Optional[typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
     from models import pages
 
-    date = datetime.now(timezone.utc)
-    page_id = data[pages.PAGE_ID]
-    __col.insert_one({
-        ARCHIVE_ID: str(uuid.uuid4()),
-        ARCHIVED_DATE: date,
+    data = dict(data)
+    content = data.pop(pages.CONTENT)
+    if keyframe is None:
+        base = revision
+        compressed = __compress(content)
+    else:
+        base = keyframe[REVISION]
+        compressed = __compress(__diff(__decompress(keyframe[CONTENT]), content))
+
+    return {
         PAGE_DATA: data,
-        PAGE_ID: page_id
-    })
+        REVISION: revision,
+        BASE: base,
+        CONTENT: compressed,
+        SIZE: len(content)
+    }
+
+
+def __keyframes(docs: typing.Iterable[typing.Dict[str, typing.Any]]) -> typing.Dict[int, typing.Dict[str, typing.Any]]:
+    docs = list(docs)
+    wanted = set((doc[PAGE_ID], doc[BASE]) for doc in docs if REVISION in doc and doc[BASE] != doc[REVISION])
+    keyframes = {(doc[PAGE_ID], doc[REVISION]): doc for doc in docs if REVISION in doc and doc[BASE] == doc[REVISION]}
+    wanted -= keyframes.keys()
+    for pid, base in wanted:
+        keyframe = __col().find_one({PAGE_ID: pid, REVISION: base, BASE: base}, {"_id": False})
+        if keyframe is not None:
+            keyframes[(pid, base)] = keyframe
+    return keyframes
+
+
+def __reconstruct(
+        doc: typing.Dict[str, typing.Any],
+        keyframes: typing.Dict[typing.Tuple[str, int], typing.Dict[str, typing.Any]]) -> typing.Dict[str, typing.Any]:
+    from models import pages
+
+    if REVISION not in doc:
+        return doc
+
+    if doc[BASE] == doc[REVISION]:
+        content = __decompress(doc[CONTENT])
+    else:
+        keyframe = keyframes[(doc[PAGE_ID], doc[BASE])]
+        content = __patch(__decompress(keyframe[CONTENT]), __decompress(doc[CONTENT]))
+
+    data = dict(doc[PAGE_DATA])
+    data[pages.CONTENT] = content
+    return {
+        ARCHIVE_ID: doc[ARCHIVE_ID],
+        ARCHIVED_DATE: doc[ARCHIVED_DATE],
+        PAGE_DATA: data,
+        PAGE_ID: doc[PAGE_ID],
+        REVISION: doc[REVISION]
+    }
+
+
+def __latest_keyframe(pid: str, session=None) -> typing.Tuple[int, typing.Optional[typing.Dict[str, typing.Any]]]:
+    last = __col().find_one(
+        {PAGE_ID: pid, REVISION: {"$exists": True}},
+        {"_id": False, REVISION: True, BASE: True},
+        sort=[(REVISION, pymongo.DESCENDING)],
+        session=session)
+    if last is None:
+        return 0, None
+
+    revision = last[REVISION] + 1
+    if revision - last[BASE] >= settings.ARCHIVE_KEYFRAME_INTERVAL:
+        return revision, None
+    keyframe = __col().find_one({PAGE_ID: pid, REVISION: last[BASE], BASE: last[BASE]}, {"_id": False}, session=session)
+    return revision, keyframe
+
+
+def add(data: typing.Dict[str, typing.Any], session=None, page_id: typing.Optional[str]=None):
+    # session: db.run_transaction() of the page update
+    # page_id: current ID of the page (when the update renamed it)
+    from models import pages
+
+    date = datetime.now(timezone.utc)
+    if page_id is None:
+        page_id = data[pages.PAGE_ID]
+    while True:
+        revision, keyframe = __latest_keyframe(page_id, session)
+
+        doc = __encode(data, revision, keyframe)
+        doc[ARCHIVE_ID] = str(uuid.uuid4())
+        doc[ARCHIVED_DATE] = date
+        doc[PAGE_ID] = page_id
+        try:
+            __col().insert_one(doc, session=session)
+            return
+        except DuplicateKeyError:
+            # Another update of the page took this revision (the unique index on page ID and revision).
+            # A transaction is aborted by the error, so the whole page update is run again instead.
+            if session is not None:
+                raise
+
+
+def add_many(pid: str, revisions: typing.Iterable[typing.Tuple[datetime, typing.Dict[str, typing.Any]]]):
+    # (archived date, page data) of a page, oldest first (bulk import)
+    revision, keyframe = __latest_keyframe(pid)
+    docs = []
+    for date, data in revisions:
+        if keyframe is not None and revision - keyframe[REVISION] >= settings.ARCHIVE_KEYFRAME_INTERVAL:
+            keyframe = None
+        doc = __encode(data, revision, keyframe)
+        doc[ARCHIVE_ID] = str(uuid.uuid4())
+        doc[ARCHIVED_DATE] = date
+        doc[PAGE_ID] = pid
+        if keyframe is None:
+            keyframe = doc
+        docs.append(doc)
+        revision += 1
+    if len(docs) > 0:
+        __col().insert_many(docs)
+
+
+def rename(old_pid: str, pid: str, session=None):
+    # Archives follow the page, so that its history is kept after the title (ID) changes
+    __col().update_many({PAGE_ID: old_pid}, {"$set": {PAGE_ID: pid}}, session=session)
 
 
 def get(aid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
-    return __col.find_one({ARCHIVE_ID: aid}, {"_id": False})
+    doc = __col().find_one({ARCHIVE_ID: aid}, {"_id": False})
+    if doc is None:
+        return None
+    return __reconstruct(doc, __keyframes([doc]))
 
 
 def get_by_page(pid: str) -> typing.List[typing.Dict[str, typing.Any]]:
-    return list(__col.find({PAGE_ID: pid}, {"_id": False}))
+    docs = list(__col().find({PAGE_ID: pid}, {"_id": False}).sort(ARCHIVED_DATE, pymongo.ASCENDING))
+    keyframes = __keyframes(docs)
+    return [__reconstruct(doc, keyframes) for doc in docs]
+
+
+def get_history(
+        pid: str,
+        before: typing.Optional[datetime]=None,
+        n_item=50) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.Optional[datetime]]:
+    from models import pages
+
+    query = {PAGE_ID: pid}
+    if before is not None:
+        query[ARCHIVED_DATE] = {"$lt": before}
+
+    projection = {
+        "_id": False,
+        ARCHIVE_ID: True,
+        ARCHIVED_DATE: True,
+        REVISION: True,
+        SIZE: True,
+        PAGE_DATA + "." + pages.TITLE: True,
+        PAGE_DATA + "." + pages.UPDATE: True
+    }
+    cursor = __col(secondary=True).find(query, projection)
+    data = list(cursor.sort(ARCHIVED_DATE, pymongo.DESCENDING).limit(n_item + 1))
+
+    if len(data) <= n_item:
+        return data, None
+    data = data[:n_item]
+    return data, data[-1][ARCHIVED_DATE]
+
+
+def reconstruct(pid: str, revision: int) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    doc = __col().find_one({PAGE_ID: pid, REVISION: revision}, {"_id": False})
+    if doc is None:
+        return None
+    return __reconstruct(doc, __keyframes([doc]))
+
+
+def __rebase(pid: str, revisions: typing.List[typing.Dict[str, typing.Any]]):
+    # Re-encode revisions in order, starting a new keyframe every ARCHIVE_KEYFRAME_INTERVAL revisions.
+    # Current revisions are moved to negative numbers first, so that the unique index does not reject
+    # a revision number still used by another document (archives of older versions come first).
+    cursor = __col().find({PAGE_ID: pid, REVISION: {"$gte": 0}},
+                          {"_id": False, ARCHIVE_ID: True, REVISION: True, BASE: True})
+    requests = [
+        pymongo.UpdateOne({ARCHIVE_ID: doc[ARCHIVE_ID]}, {"$set": {REVISION: -1 - doc[REVISION], BASE: -1 - doc[BASE]}})
+        for doc in cursor
+    ]
+    keyframe = None
+    for revision, doc in enumerate(revisions):
+        if keyframe is not None and revision - keyframe[REVISION] >= settings.ARCHIVE_KEYFRAME_INTERVAL:
+            keyframe = None
+        encoded = __encode(doc[PAGE_DATA], revision, keyframe)
+        if keyframe is None:
+            keyframe = encoded
+        requests.append(pymongo.UpdateOne(
+            {ARCHIVE_ID: doc[ARCHIVE_ID]},
+            {"$set": encoded}))
+    if len(requests) > 0:
+        __col().bulk_write(requests, ordered=True)
 
 
 def remove(aid: typing.Union[str, typing.List[str]]):
     if isinstance(aid, str):
-        __col.delete_one({ARCHIVE_ID: aid})
-    else:
-        __col.delete_many({"$or": aid})
+        aid = [aid]
+
+    pids = __col().distinct(PAGE_ID, {ARCHIVE_ID: {"$in": aid}})
+    for pid in pids:
+        revisions = [doc for doc in get_by_page(pid) if doc[ARCHIVE_ID] not in aid]
+        __col().delete_many({PAGE_ID: pid, ARCHIVE_ID: {"$in": aid}})
+        __rebase(pid, revisions)
+
+
+def migrate():
+    for pid in __col().distinct(PAGE_ID, {REVISION: {"$exists": False}}):
+        __rebase(pid, get_by_page(pid))
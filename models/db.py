@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import contextlib
+import os
+import threading
+import typing
+
+import pymongo
+from pymongo.errors import DuplicateKeyError, OperationFailure, PyMongoError
+from pymongo.client_session import ClientSession
+from pymongo import ReadPreference
+
+import settings
+from core import metrics
+
+
+__client = None
+__pid = None
+__transactions = None
+__lock = threading.Lock()
+
+# Attempts of a transaction which conflicts with concurrent ones
+_TRANSACTION_ATTEMPTS = 5
+
+READ_PREFERENCES = {
+    "primary": ReadPreference.PRIMARY,
+    "primaryPreferred": ReadPreference.PRIMARY_PREFERRED,
+    "secondary": ReadPreference.SECONDARY,
+    "secondaryPreferred": ReadPreference.SECONDARY_PREFERRED,
+    "nearest": ReadPreference.NEAREST,
+}
+
+
+def get_client() -> pymongo.MongoClient:
+    global __client, __pid
+
+    # A client must not be shared with a forked process (pre-fork servers).
+    if __client is None or __pid != os.getpid():
+        with __lock:
+            if __client is None or __pid != os.getpid():
+                __client = pymongo.MongoClient(
+                    settings.MONGO_URI,
+                    tz_aware=True,
+                    connect=False,
+                    maxPoolSize=settings.MONGO_MAX_POOL_SIZE,
+                    connectTimeoutMS=settings.MONGO_CONNECT_TIMEOUT_MS,
+                    serverSelectionTimeoutMS=settings.MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                    socketTimeoutMS=settings.MONGO_SOCKET_TIMEOUT_MS,
+                    event_listeners=[metrics.CommandListener()] if settings.METRICS_ENABLED else [])
+                __pid = os.getpid()
+    return __client
+
+
+def set_client(client: pymongo.MongoClient):
+    # Use another client, e.g. mongomock for benchmarks.
+    global __client, __pid, __transactions
+
+    __client = client
+    __pid = os.getpid()
+    __transactions = None
+
+
+def reset():
+    global __client, __pid, __transactions
+
+    __client = None
+    __pid = None
+    __transactions = None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset)
+
+
+def supports_transactions() -> bool:
+    # Multi-document transactions need pymongo 3.7+ and a replica set (MongoDB 4.0+) or mongos (4.2+).
+    global __transactions
+
+    if __transactions is None:
+        if not hasattr(ClientSession, "start_transaction"):
+            __transactions = False
+        else:
+            try:
+                info = get_client().admin.command("ismaster")
+            except (OperationFailure, NotImplementedError):
+                # Servers or clients (mongomock) which do not answer ismaster
+                info = {}
+            wire_version = info.get("maxWireVersion", 0)
+            __transactions = ("setName" in info and wire_version >= 7) or \
+                             (info.get("msg") == "isdbgrid" and wire_version >= 8)
+    return __transactions
+
+
+@contextlib.contextmanager
+def transaction():
+    # Yields a session in a transaction (committed at the end, aborted on exceptions),
+    # or None where transactions are not available.
+    if not supports_transactions():
+        yield None
+        return
+    with get_client().start_session() as session:
+        with session.start_transaction():
+            yield session
+
+
+def is_conflict(error: PyMongoError) -> bool:
+    # A concurrent transaction wrote the same document (WriteConflict, labelled TransientTransactionError)
+    # or committed a value of a unique index first
+    return error.has_error_label("TransientTransactionError") or isinstance(error, DuplicateKeyError)
+
+
+def run_transaction(fn: typing.Callable[[typing.Optional[ClientSession]], typing.Any]):
+    # Returns fn(session) run in a transaction, which is run again in a new transaction when it conflicts
+    # with a concurrent one, or fn(None) where transactions are not available.
+    if not supports_transactions():
+        return fn(None)
+    attempt = 1
+    while True:
+        try:
+            with transaction() as session:
+                return fn(session)
+        except PyMongoError as e:
+            if not is_conflict(e) or attempt >= _TRANSACTION_ATTEMPTS:
+                raise
+            attempt += 1
+
+
+def get_database():
+    return get_client()[settings.MONGO_DATABASE]
+
+
+def collection(name: str, secondary=False):
+    # secondary: reads which may lag behind writes (search, listings)
+    if secondary:
+        read_preference = READ_PREFERENCES[settings.MONGO_READ_PREFERENCE]
+        return get_database().get_collection(name, read_preference=read_preference)
+    return get_database()[name]
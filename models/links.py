@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import typing
+
+import pymongo
+
+from models import db
+
+
+def __col(secondary=False):
+    return db.collection("links", secondary)
+
+
+SOURCE = "source"
+SOURCE_TITLE = "title"
+TARGET = "target"
+BROKEN = "broken"
+
+"""
+{
+    "source": page ID which has `.. related:: TARGET`,
+    "title": title of the source page,
+    "target": page ID,
+    "broken": True if no page has the target ID
+}
+"""
+
+_BATCH_SIZE = 1000
+
+
+def replace(source: str, title: str, targets: typing.Dict[str, bool]):
+    # targets: target -> broken
+    requests = [pymongo.DeleteMany({SOURCE: source})]
+    requests += [
+        pymongo.InsertOne({SOURCE: source, SOURCE_TITLE: title, TARGET: target, BROKEN: broken})
+        for target, broken in targets.items()
+    ]
+    __col().bulk_write(requests, ordered=True)
+
+
+def remove(source: str):
+    __col().delete_many({SOURCE: source})
+
+
+def set_broken(targets: typing.List[str], broken: bool):
+    if len(targets) > 0:
+        __col().update_many({TARGET: {"$in": targets}, BROKEN: not broken}, {"$set": {BROKEN: broken}})
+
+
+def add_many(links: typing.Iterable[typing.Dict[str, typing.Any]]):
+    batch = []
+    for link in links:
+        batch.append(link)
+        if len(batch) >= _BATCH_SIZE:
+            __col().insert_many(batch, ordered=False)
+            batch = []
+    if len(batch) > 0:
+        __col().insert_many(batch, ordered=False)
+
+
+def rebuild(links: typing.Iterable[typing.Dict[str, typing.Any]]):
+    __col().delete_many({})
+    add_many(links)
+
+
+def get_backlinks(target: str, n_item=100) -> typing.List[typing.Dict[str, typing.Any]]:
+    # [{"source": ..., "title": ...}] sorted by title
+    cursor = __col(secondary=True).find({TARGET: target}, {"_id": False, SOURCE: True, SOURCE_TITLE: True})
+    return list(cursor.sort([(SOURCE_TITLE, pymongo.ASCENDING), (SOURCE, pymongo.ASCENDING)]).limit(n_item))
+
+
+def get_broken(offset=0, n_item=100) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], int]:
+    # Links to missing pages, sorted by target
+    query = {BROKEN: True}
+    cursor = __col(secondary=True).find(query, {"_id": False})
+    cursor = cursor.sort([(TARGET, pymongo.ASCENDING), (SOURCE_TITLE, pymongo.ASCENDING)]).skip(offset).limit(n_item)
+    count = list(__col(secondary=True).aggregate([{"$match": query}, {"$count": "count"}]))
+    return list(cursor), count[0]["count"] if len(count) > 0 else 0
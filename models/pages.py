@@ -17,21 +17,26 @@
    limitations under the License.
 """
 
+import threading
 import typing
 import uuid
 from datetime import datetime, timezone
-from concurrent.futures import ThreadPoolExecutor as Executor
-from functools import reduce
 
 import pymongo
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, PyMongoError
 
 import settings
-from models import archive
+from core import cache, util
+from models import archive, db, links, search
 
 
-__client = pymongo.MongoClient(tz_aware=True)
-__db = __client["e97"]
-__col = __db["pages"]
+def __col(secondary=False):
+    return db.collection("pages", secondary)
+
+
+def __letters(secondary=False):
+    return db.collection("letters", secondary)
 
 
 PAGE_ID = "id"
@@ -41,12 +46,28 @@ UPDATE = "update"
 CREATE = "create"
 BY = "by"
 DATE = "date"
+SCORE = "score"
+INITIAL = "initial"
+LETTER = "letter"
+COUNT = "count"
+RENDERED = "rendered"
+RENDER_KEY = "key"
+HTML = "html"
+VERSION = "version"
+
+__search = search.create(settings.SEARCH_BACKEND)
+__latest_cache = cache.TTLCache(4, settings.LATEST_CACHE_TTL)
+# Changes whenever the latest page list changes (key of the rendered list)
+__latest_generation = 0
+__latest_seen = {}
+__latest_lock = threading.Lock()
 
 
 """
 {
     "id": PAGE_ID,
     "title": TITLE,
+    "initial": upper case first letter of TITLE,
     "content": reStructuredText,
     "update": {
         "by": USER_ID,
@@ -55,185 +76,369 @@ DATE = "date"
     "create": {
         "by": USER_ID,
         "date": datetime
-    }
+    },
+    "rendered": {
+        "key": util.render_key(content),
+        "html": HTML
+    },
+    "version": incremented by each update (missing in pages saved by older versions)
+}
+"""
+
+"""
+letters
+{
+    "letter": INITIAL,
+    "count": number of pages
 }
 """
 
 
+def __initial(title: str) -> str:
+    return title[:1].upper()
+
+
+def __count_letter(letter: str, n: int):
+    __letters().update_one({LETTER: letter}, {"$inc": {COUNT: n}}, upsert=True)
+    if n < 0:
+        __letters().delete_one({LETTER: letter, COUNT: {"$lte": 0}})
+
+
+def __existing(pids: typing.Iterable[str]) -> typing.Set[str]:
+    pids = list(pids)
+    if len(pids) == 0:
+        return set()
+    return set(datum[PAGE_ID] for datum in __col().find({PAGE_ID: {"$in": pids}}, {"_id": False, PAGE_ID: True}))
+
+
+def __update_links(pid: str, title: str, content: str):
+    targets = util.related_targets(content)
+    existing = __existing(targets)
+    links.replace(pid, title, {target: target not in existing for target in targets})
+
+
 def add(title: str, content: str, author: str) -> typing.Optional[str]:
     page_id = str(uuid.uuid4()) if settings.SEPARATE_PAGE_TITLE_AND_ID else title
-    if __col.count({PAGE_ID: page_id}) > 0:
-        return None
-
     date = datetime.now(timezone.utc)
 
-    __col.insert_one({
-        PAGE_ID: page_id,
-        TITLE: title,
-        CONTENT: content,
-        UPDATE: {
-            BY: author,
-            DATE: date
-        },
-        CREATE: {
-            BY: author,
-            DATE: date
-        }
-    })
+    try:
+        # The unique index on id rejects existing pages.
+        __col().insert_one({
+            PAGE_ID: page_id,
+            TITLE: title,
+            INITIAL: __initial(title),
+            CONTENT: content,
+            UPDATE: {
+                BY: author,
+                DATE: date
+            },
+            CREATE: {
+                BY: author,
+                DATE: date
+            },
+            VERSION: 0
+        })
+    except DuplicateKeyError:
+        return None
+    __search.add(page_id, title, content)
+    __update_links(page_id, title, content)
+    links.set_broken([page_id], False)
+    __count_letter(__initial(title), 1)
+    __latest_changed()
     return page_id
 
 
+def add_many(data: typing.List[typing.Dict[str, typing.Any]]) -> typing.List[str]:
+    # Pages with id, title, content, update and create (bulk import).
+    # Returns IDs of added pages; pages whose ID already exists are skipped.
+    if len(data) == 0:
+        return []
+    docs = [dict(datum, **{INITIAL: __initial(datum[TITLE]), VERSION: 0}) for datum in data]
+    try:
+        __col().insert_many(docs, ordered=False)
+        added = docs
+    except BulkWriteError as e:
+        errors = e.details["writeErrors"]
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        duplicated = set(error["index"] for error in errors)
+        added = [doc for i, doc in enumerate(docs) if i not in duplicated]
+
+    __search.add_many((doc[PAGE_ID], doc[TITLE], doc[CONTENT]) for doc in added)
+    targets = {doc[PAGE_ID]: util.related_targets(doc[CONTENT]) for doc in added}
+    existing = __existing(set(target for ts in targets.values() for target in ts))
+    links.set_broken([doc[PAGE_ID] for doc in added], False)
+    links.add_many(
+        {links.SOURCE: doc[PAGE_ID], links.SOURCE_TITLE: doc[TITLE], links.TARGET: target,
+         links.BROKEN: target not in existing}
+        for doc in added for target in targets[doc[PAGE_ID]])
+    letters = {}
+    for doc in added:
+        letters[doc[INITIAL]] = letters.get(doc[INITIAL], 0) + 1
+    if len(letters) > 0:
+        __letters().bulk_write([
+            pymongo.UpdateOne({LETTER: letter}, {"$inc": {COUNT: n}}, upsert=True) for letter, n in letters.items()
+        ], ordered=False)
+    __latest_changed()
+    return [doc[PAGE_ID] for doc in added]
+
+
+def __version_query(pid: str, version: typing.Optional[int]) -> typing.Dict[str, typing.Any]:
+    if version is None:
+        return {PAGE_ID: pid}
+    if version == 0:
+        return {PAGE_ID: pid, VERSION: {"$in": [0, None]}}
+    return {PAGE_ID: pid, VERSION: version}
+
+
+def __abort(session):
+    if session is not None:
+        session.abort_transaction()
+
+
+def __rename(
+        query: typing.Dict[str, typing.Any],
+        change: typing.Dict[str, typing.Any],
+        session) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    # Insert the new page first, so that the page does not disappear if the new ID is taken.
+    old = __col().find_one(query, {"_id": False, RENDERED: False}, session=session)
+    if old is None:
+        return None
+
+    data = dict(old, **change)
+    data[PAGE_ID] = change[TITLE]
+    data[VERSION] = old.get(VERSION, 0) + 1
+    try:
+        __col().insert_one(dict(data), session=session)
+    except DuplicateKeyError:
+        __abort(session)
+        return None
+
+    if __col().delete_one(__version_query(old[PAGE_ID], old.get(VERSION, 0)), session=session).deleted_count == 0:
+        # Updated by someone else in the meantime
+        __abort(session)
+        if session is None:
+            __col().delete_one({PAGE_ID: data[PAGE_ID]})
+        return None
+    return old
+
+
 def update(
         pid: str,
         author: str,
         title: typing.Optional[str]=None,
-        content: typing.Optional[str]=None) -> typing.Optional[str]:
-
-    data = __col.find_one({PAGE_ID: pid}, {"_id": False})
-    if data is not None:
-        if settings.SAVE_TO_ARCHIVE:
-            archive.add(data)
-    else:
+        content: typing.Optional[str]=None,
+        version: typing.Optional[int]=None) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    # version: VERSION of the page which the author edited (None to overwrite any version).
+    # Returns the updated page (without rendered HTML), or None if the page does not exist,
+    # was updated after version or the new title is used by another page.
+    query = __version_query(pid, version)
+    change = {
+        UPDATE: {
+            BY: author,
+            DATE: datetime.now(timezone.utc)
+        }
+    }
+    if title is not None:
+        change[TITLE] = title
+        change[INITIAL] = __initial(title)
+    if content is not None:
+        change[CONTENT] = content
+
+    renamed = not settings.SEPARATE_PAGE_TITLE_AND_ID and title is not None and pid != title
+
+    def write(session):
+        if renamed:
+            old = __rename(query, change, session)
+        else:
+            # The rendered HTML is kept; render() replaces it when the content has changed.
+            old = __col().find_one_and_update(
+                query,
+                {"$set": change, "$inc": {VERSION: 1}},
+                {"_id": False, RENDERED: False},
+                return_document=ReturnDocument.BEFORE,
+                session=session)
+        if old is not None and settings.SAVE_TO_ARCHIVE:
+            if renamed:
+                archive.rename(old[PAGE_ID], title, session)
+            archive.add(old, session, title if renamed else None)
+        return old
+
+    # A conflicting transaction is run again, and then finds the version updated by the other one.
+    try:
+        old = db.run_transaction(write)
+    except PyMongoError as e:
+        if not db.is_conflict(e):
+            raise
+        old = None
+
+    if old is None:
         return None
 
-    if not settings.SEPARATE_PAGE_TITLE_AND_ID:
-        if title is not None and pid != title:
-            __col.delete_one({PAGE_ID: pid})
-            pid = title
+    data = dict(old, **change)
+    data[PAGE_ID] = title if renamed else pid
+    data[VERSION] = old.get(VERSION, 0) + 1
+
+    if old[CONTENT] != data[CONTENT]:
+        util.forget_html(util.render_key(old[CONTENT]))
+    __search.update(old[PAGE_ID], old[TITLE], old[CONTENT], data[PAGE_ID], data[TITLE], data[CONTENT])
+    if renamed:
+        links.remove(old[PAGE_ID])
+        links.set_broken([old[PAGE_ID]], True)
+        links.set_broken([data[PAGE_ID]], False)
+    if renamed or old[TITLE] != data[TITLE] or old[CONTENT] != data[CONTENT]:
+        __update_links(data[PAGE_ID], data[TITLE], data[CONTENT])
+    if __initial(old[TITLE]) != __initial(data[TITLE]):
+        __count_letter(__initial(data[TITLE]), 1)
+        __count_letter(__initial(old[TITLE]), -1)
+    __latest_changed()
+    return data
 
-    data[PAGE_ID] = pid
-    if title is not None:
-        data[TITLE] = title
 
-    if content is not None:
-        data[CONTENT] = content
+def get(pid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    return __col().find_one({PAGE_ID: pid}, {"_id": False})
 
-    data[UPDATE] = {
-        BY: author,
-        DATE: datetime.now(timezone.utc)
-    }
 
-    __col.update_one({PAGE_ID: pid}, {"$set": data}, upsert=True)
-    return pid
+def get_many(pids: typing.Iterable[str]) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    # Pages without rendered HTML
+    cursor = __col().find({PAGE_ID: {"$in": list(pids)}}, {"_id": False, RENDERED: False})
+    return {page[PAGE_ID]: page for page in cursor}
 
 
-def get(pid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
-    return __col.find_one({PAGE_ID: pid}, {"_id": False})
+def get_meta(pid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+    # id, title, update and version only (for conditional requests and conflicts)
+    return __col().find_one({PAGE_ID: pid}, {"_id": False, PAGE_ID: True, TITLE: True, UPDATE: True, VERSION: True})
+
+
+def render(page: typing.Dict[str, typing.Any]) -> str:
+    key = util.render_key(page[CONTENT])
+    rendered = page.get(RENDERED)
+    if rendered is not None and rendered.get(RENDER_KEY) == key:
+        return rendered[HTML]
+
+    html = util.rest_to_html(page[CONTENT], key)
+    __col().update_one({PAGE_ID: page[PAGE_ID]}, {"$set": {RENDERED: {RENDER_KEY: key, HTML: html}}})
+    return html
 
 
 def get_all() -> typing.List[typing.Dict[str, typing.Any]]:
-    return list(__col.find({}, {"_id": False}))
+    return list(__col().find({}, {"_id": False}))
+
+
+def iterate() -> typing.Iterator[typing.Dict[str, typing.Any]]:
+    # All pages (without rendered HTML) in order of ID, read in batches
+    return __col().find({}, {"_id": False, RENDERED: False}).sort(PAGE_ID, pymongo.ASCENDING)
 
 
 def get_all_as_index(is_sorted=True) -> typing.Dict[str, typing.List[typing.Dict[str, typing.Any]]]:
-    data = get_all()
+    cursor = __col(secondary=True).find({}, {"_id": False, PAGE_ID: True, TITLE: True, INITIAL: True})
+    if is_sorted:
+        cursor = cursor.sort([(INITIAL, pymongo.ASCENDING), (TITLE, pymongo.ASCENDING), (PAGE_ID, pymongo.ASCENDING)])
+
     results = {}
-    for datum in data:
-        key = datum[TITLE][:1]
-        key = key.upper()
+    for datum in cursor:
+        key = datum.pop(INITIAL, None)
+        if key is None:
+            key = __initial(datum[TITLE])
         if key not in results:
             results[key] = []
         results[key].append(datum)
 
-    if is_sorted:
-        res = sorted(results.items(), key=lambda x: x[0])
-        results.clear()
-        for k, v in res:
-            results[k] = v
-
     return results
 
 
-def get_latest(n_item=20) -> typing.List[typing.Dict[str, typing.Any]]:
-    data = get_all()
-    data.sort(key=lambda x: x[UPDATE][DATE])
-    data.reverse()
-    return data[:n_item]
+def get_index_letters() -> typing.List[typing.Tuple[str, int]]:
+    cursor = __letters(secondary=True).find({COUNT: {"$gt": 0}}, {"_id": False}).sort(LETTER, pymongo.ASCENDING)
+    return [(datum[LETTER], datum[COUNT]) for datum in cursor]
+
 
+def get_index_page(
+        letter: str,
+        after: typing.Optional[typing.Tuple[str, str]]=None,
+        n_item=100) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], typing.Optional[typing.Tuple[str, str]]]:
+    query = {INITIAL: letter}
+    if after is not None:
+        after_title, after_pid = after
+        query["$or"] = [
+            {TITLE: {"$gt": after_title}},
+            {TITLE: after_title, PAGE_ID: {"$gt": after_pid}}
+        ]
 
-def __and_search(
-        executor: Executor,
-        target: typing.List[typing.Dict[str, typing.Any]],
-        and_query: typing.List[str]) -> typing.List[typing.Dict[str, typing.Any]]:
-    and_query = [q.lower() for q in and_query]
+    cursor = __col(secondary=True).find(query, {"_id": False, PAGE_ID: True, TITLE: True})
+    cursor = cursor.sort([(TITLE, pymongo.ASCENDING), (PAGE_ID, pymongo.ASCENDING)]).limit(n_item + 1)
+    data = list(cursor)
 
-    def __and_impl(data, query):
-        title = data[TITLE].lower()
-        point = reduce(lambda x, y: x + y, [title.count(q) for q in query]) * 2
+    if len(data) <= n_item:
+        return data, None
+    data = data[:n_item]
+    return data, (data[-1][TITLE], data[-1][PAGE_ID])
 
-        content = data[CONTENT].lower()
-        point += reduce(lambda x, y: x + y, [content.count(q) for q in query])
-        data["__point"] = point
-        return data
 
-    res = executor.map(lambda t: __and_impl(t, and_query), target)
+def rebuild_title_index():
+    requests = [
+        pymongo.UpdateOne({"_id": datum["_id"]}, {"$set": {INITIAL: __initial(datum[TITLE])}})
+        for datum in __col().find({INITIAL: {"$exists": False}}, {TITLE: True})
+    ]
+    if len(requests) > 0:
+        __col().bulk_write(requests, ordered=False)
 
-    result = []
-    for r in res:
-        if r["__point"] > 0:
-            result.append(r)
+    counts = __col().aggregate([{"$group": {"_id": "$" + INITIAL, COUNT: {"$sum": 1}}}])
+    __letters().delete_many({})
+    letters = [{LETTER: datum["_id"], COUNT: datum[COUNT]} for datum in counts]
+    if len(letters) > 0:
+        __letters().insert_many(letters)
 
-    return result
 
+def __latest_changed():
+    global __latest_generation
 
-def __or_search(
-        executor: Executor,
-        target: typing.List[typing.Dict[str, typing.Any]],
-        or_query: typing.List[str]) -> typing.List[typing.Dict[str, typing.Any]]:
-    or_query = [q.lower() for q in or_query]
+    with __latest_lock:
+        __latest_generation += 1
+    __latest_cache.clear()
 
-    def __or_impl(data, query):
-        title = data[TITLE].lower()
-        point = reduce(lambda x, y: x + y, [title.count(q) for q in query]) * 2
 
-        content = data[CONTENT].lower()
-        point += reduce(lambda x, y: x + y, [content.count(q) for q in query])
-        data["__point"] += point
-        return data
+def get_latest(n_item=20) -> typing.List[typing.Dict[str, typing.Any]]:
+    global __latest_generation
 
-    res = executor.map(lambda t: __or_impl(t, or_query), target)
+    data = __latest_cache.get(n_item)
+    if data is None:
+        cursor = __col().find({}, {"_id": False, PAGE_ID: True, TITLE: True, UPDATE: True})
+        data = list(cursor.sort(UPDATE + "." + DATE, pymongo.DESCENDING).limit(n_item))
+        # Pages updated by other processes
+        with __latest_lock:
+            if __latest_seen.get(n_item) != data:
+                __latest_seen[n_item] = data
+                __latest_generation += 1
+        __latest_cache.put(n_item, data)
+    return data
 
-    return list(res)
 
+def get_latest_generation() -> int:
+    return __latest_generation
 
-def __not_search(
-        executor: Executor,
-        target: typing.List[typing.Dict[str, typing.Any]],
-        not_query: typing.List[str]) -> typing.List[typing.Dict[str, typing.Any]]:
-    not_query = [q.lower() for q in not_query]
 
-    def __not_impl(data, query):
-        title = data[TITLE].lower()
-        point = reduce(lambda x, y: x + y, [title.count(q) for q in query]) * 2
+def rebuild_search_index():
+    __search.rebuild()
 
-        content = data[CONTENT].lower()
-        point += reduce(lambda x, y: x + y, [content.count(q) for q in query])
-        data["__point"] -= point
-        return data
 
-    res = executor.map(lambda t: __not_impl(t, not_query), target)
+def rebuild_links():
+    pids = set(datum[PAGE_ID] for datum in __col().find({}, {"_id": False, PAGE_ID: True}))
+    cursor = __col().find({}, {"_id": False, PAGE_ID: True, TITLE: True, CONTENT: True})
+    links.rebuild(
+        {links.SOURCE: datum[PAGE_ID], links.SOURCE_TITLE: datum[TITLE], links.TARGET: target,
+         links.BROKEN: target not in pids}
+        for datum in cursor for target in util.related_targets(datum[CONTENT]))
 
-    result = []
-    for r in res:
-        if r["__point"] > 0:
-            result.append(r)
 
-    return result
+def get_backlinks(pid: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    # Pages which have `.. related:: pid` ([{"id": ..., "title": ...}])
+    return [{PAGE_ID: link[links.SOURCE], TITLE: link[links.SOURCE_TITLE]} for link in links.get_backlinks(pid)]
 
 
 def search(
         and_query: typing.Optional[typing.List[str]],
         or_query: typing.Optional[typing.List[str]],
-        not_query: typing.Optional[typing.List[str]]) -> typing.List[typing.Dict[str, typing.Any]]:
-    target = get_all()
-
-    with Executor() as executor:
-        if and_query is not None and len(and_query) > 0:
-            target = __and_search(executor, target, and_query)
-        if or_query is not None and len(or_query) > 0:
-            target = __or_search(executor, target, or_query)
-        if not_query is not None and len(not_query) > 0:
-            target = __not_search(executor, target, not_query)
-
-    target.sort(key=lambda x: x["__point"])
-    return target
+        not_query: typing.Optional[typing.List[str]],
+        offset=0,
+        n_item=20) -> typing.Tuple[typing.List[typing.Dict[str, typing.Any]], int]:
+    return __search.search(and_query or [], or_query or [], not_query or [], offset, n_item)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+import sys
+import typing
+
+from pymongo import IndexModel, ASCENDING, DESCENDING, TEXT
+from pymongo.errors import OperationFailure
+
+import settings
+from core import export, session_store
+from models import archive, db, links, pages, search_index, users
+
+
+INDEXES = {
+    "pages": [
+        IndexModel([(pages.PAGE_ID, ASCENDING)], name="id", unique=True),
+        IndexModel([(pages.UPDATE + "." + pages.DATE, DESCENDING)], name="update_date"),
+        IndexModel([(pages.INITIAL, ASCENDING), (pages.TITLE, ASCENDING), (pages.PAGE_ID, ASCENDING)],
+                   name="initial_title"),
+    ],
+    "letters": [
+        IndexModel([(pages.LETTER, ASCENDING)], name="letter", unique=True),
+    ],
+    "users": [
+        IndexModel([(users.USER_ID, ASCENDING)], name="id", unique=True),
+    ],
+    "archive": [
+        IndexModel([(archive.ARCHIVE_ID, ASCENDING)], name="id", unique=True),
+        IndexModel([(archive.PAGE_ID, ASCENDING), (archive.ARCHIVED_DATE, DESCENDING)], name="page_id_date"),
+        # Concurrent archive.add calls must not take the same revision (archives of older versions have none)
+        IndexModel([(archive.PAGE_ID, ASCENDING), (archive.REVISION, DESCENDING)], name="page_id_revision_unique",
+                   unique=True, partialFilterExpression={archive.REVISION: {"$exists": True}}),
+    ],
+    "search_index": [
+        IndexModel([(search_index.TERM, ASCENDING), (search_index.PAGE_ID, ASCENDING)], name="term_page_id",
+                   unique=True),
+        IndexModel([(search_index.PAGE_ID, ASCENDING)], name="page_id"),
+    ],
+    "sessions": [
+        IndexModel([(session_store.USER_ID, ASCENDING)], name="id", unique=True),
+        IndexModel([(session_store.EXPIRE, ASCENDING)], name="expire", expireAfterSeconds=0),
+    ],
+    "links": [
+        IndexModel([(links.SOURCE, ASCENDING), (links.TARGET, ASCENDING)], name="source_target", unique=True),
+        IndexModel([(links.TARGET, ASCENDING), (links.SOURCE_TITLE, ASCENDING), (links.SOURCE, ASCENDING)],
+                   name="target_title"),
+        IndexModel([(links.BROKEN, ASCENDING), (links.TARGET, ASCENDING), (links.SOURCE_TITLE, ASCENDING)],
+                   name="broken_target"),
+    ],
+    "export_jobs": [
+        IndexModel([(export.JOB_ID, ASCENDING)], name="id", unique=True),
+        IndexModel([(export.EXPIRE, ASCENDING)], name="expire", expireAfterSeconds=0),
+    ],
+}
+
+# Index of the text search backend
+TEXT_INDEX = IndexModel(
+    [(pages.TITLE, TEXT), (pages.CONTENT, TEXT)],
+    name="text",
+    weights={pages.TITLE: 2, pages.CONTENT: 1},
+    default_language="none")
+
+if settings.SEARCH_BACKEND == "text":
+    INDEXES["pages"].append(TEXT_INDEX)
+
+
+def unique(collection: str, name: str) -> bool:
+    # Unique indexes keep page IDs, revisions, ... from being duplicated (not only faster queries)
+    return any(index.document["name"] == name and index.document.get("unique", False)
+               for index in INDEXES.get(collection, []))
+
+
+def missing() -> typing.List[typing.Tuple[str, str]]:
+    result = []
+    for collection, indexes in INDEXES.items():
+        existing = db.collection(collection).index_information()
+        for index in indexes:
+            name = index.document["name"]
+            if name not in existing:
+                result.append((collection, name))
+    return result
+
+
+# Indexes replaced by another one
+OBSOLETE_INDEXES = {
+    "archive": ["page_id_revision"],
+}
+
+
+def migrate():
+    for collection, names in OBSOLETE_INDEXES.items():
+        existing = db.collection(collection).index_information()
+        for name in names:
+            if name in existing:
+                db.collection(collection).drop_index(name)
+    archive.migrate()
+    pages.rebuild_title_index()
+    if settings.SEARCH_BACKEND == "index" and \
+            db.collection("search_index").find_one() is None and db.collection("pages").find_one() is not None:
+        pages.rebuild_search_index()
+    if db.collection("links").find_one() is None and db.collection("pages").find_one() is not None:
+        pages.rebuild_links()
+
+
+def create() -> typing.List[typing.Tuple[str, str, str]]:
+    failures = []
+    for collection, indexes in INDEXES.items():
+        for index in indexes:
+            try:
+                db.collection(collection).create_indexes([index])
+            except OperationFailure as e:
+                failures.append((collection, index.document["name"], str(e)))
+    return failures
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create or verify MongoDB indexes of e97")
+    parser.add_argument("--check", action="store_true", help="only report missing indexes")
+    args = parser.parse_args()
+
+    if args.check:
+        _missing = missing()
+        for _collection, _name in _missing:
+            print("missing: {}.{}".format(_collection, _name))
+        print("NG" if len(_missing) > 0 else "OK")
+        sys.exit(1 if len(_missing) > 0 else 0)
+
+    migrate()
+    _failures = create()
+    for _collection, _name, _message in _failures:
+        print("failed: {}.{}: {}".format(_collection, _name, _message))
+    print("NG" if len(_failures) > 0 else "OK")
+    sys.exit(1 if len(_failures) > 0 else 0)
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+import heapq
+import sys
+import threading
+import typing
+from datetime import timedelta
+
+import pymongo
+
+import settings
+from core import util
+from models import db, search_index, search_snapshot
+
+
+Result = typing.Tuple[typing.List[typing.Dict[str, typing.Any]], int]
+
+"""
+Search backend
+    search(and_query, or_query, not_query, offset, n_item) -> ([{"id", "title", "score"}], total)
+    add(pid, title, content)
+    add_many([(pid, title, content)])
+    update(old_pid, old_title, old_content, pid, title, content)
+    rebuild()
+"""
+
+
+def parse_query(query: str) -> typing.Tuple[typing.List[str], typing.List[str], typing.List[str]]:
+    # "word -word" -> (AND words, OR words, NOT words)
+    and_query = []
+    or_query = []
+    not_query = []
+    for q in query.replace("\u3000", " ").split(" "):
+        if len(q) == 0:
+            continue
+        if q.startswith("-"):
+            if len(q) > 1:
+                not_query.append(q[1:])
+        else:
+            and_query.append(q)
+    return and_query, or_query, not_query
+
+
+def _pages():
+    return db.collection("pages", secondary=True)
+
+
+def _top(
+        target: typing.Dict[str, int],
+        offset: int,
+        n_item: int,
+        titles: typing.Optional[typing.Dict[str, str]]=None) -> Result:
+    from models import pages
+
+    top = heapq.nsmallest(offset + n_item, target.items(), key=lambda x: (-x[1], x[0]))[offset:]
+    if len(top) == 0:
+        return [], len(target)
+
+    if titles is None:
+        cursor = _pages().find({pages.PAGE_ID: {"$in": [pid for pid, _ in top]}},
+                               {"_id": False, pages.PAGE_ID: True, pages.TITLE: True})
+        titles = {page[pages.PAGE_ID]: page[pages.TITLE] for page in cursor}
+
+    result = [
+        {pages.PAGE_ID: pid, pages.TITLE: titles[pid], pages.SCORE: point}
+        for pid, point in top if pid in titles
+    ]
+    return result, len(target)
+
+
+class IndexBackend:
+    """Posting lists of the search_index collection."""
+
+    @staticmethod
+    def __and_search(
+            postings: typing.Dict[str, typing.Dict[str, int]],
+            and_query: typing.List[str]) -> typing.Dict[str, int]:
+        lists = sorted((postings[q] for q in and_query), key=len)
+        result = dict(lists[0])
+        for other in lists[1:]:
+            result = {pid: point + other[pid] for pid, point in result.items() if pid in other}
+        return result
+
+    @staticmethod
+    def __or_search(
+            postings: typing.Dict[str, typing.Dict[str, int]],
+            target: typing.Dict[str, int],
+            or_query: typing.List[str]) -> typing.Dict[str, int]:
+        result = dict(target)
+        for q in or_query:
+            for pid, point in postings[q].items():
+                result[pid] = result.get(pid, 0) + point
+        return result
+
+    @staticmethod
+    def __not_search(
+            postings: typing.Dict[str, typing.Dict[str, int]],
+            target: typing.Dict[str, int],
+            not_query: typing.List[str]) -> typing.Dict[str, int]:
+        excluded = set()
+        for q in not_query:
+            excluded.update(postings[q].keys())
+        return {pid: point for pid, point in target.items() if pid not in excluded}
+
+    def _lookup(self, queries: typing.List[str]) -> typing.Dict[str, typing.Dict[str, int]]:
+        return search_index.lookup(queries)
+
+    def search(self, and_query, or_query, not_query, offset, n_item) -> Result:
+        postings = self._lookup(and_query + or_query + not_query)
+
+        target = {}
+        if len(and_query) > 0:
+            target = self.__and_search(postings, and_query)
+        if len(or_query) > 0:
+            target = self.__or_search(postings, target, or_query)
+        if len(not_query) > 0 and len(target) > 0:
+            target = self.__not_search(postings, target, not_query)
+
+        return _top(target, offset, n_item)
+
+    def add(self, pid, title, content):
+        search_index.add(pid, title, content)
+
+    def add_many(self, pages):
+        search_index.add_many(pages)
+
+    def update(self, old_pid, old_title, old_content, pid, title, content):
+        search_index.update(old_pid, old_title, old_content, pid, title, content)
+
+    def rebuild(self):
+        from models import pages
+
+        cursor = _pages().find({}, {"_id": False, pages.PAGE_ID: True, pages.TITLE: True, pages.CONTENT: True})
+        search_index.rebuild((p[pages.PAGE_ID], p[pages.TITLE], p[pages.CONTENT]) for p in cursor)
+
+
+# Pages updated this long before the newest replayed page are read again: a write can be committed
+# after another write with a later date (concurrent edits, clocks of hosts, writes during a rebuild).
+_CATCH_UP_MARGIN = timedelta(minutes=5)
+
+
+class MemoryBackend(IndexBackend):
+    """
+    Inverted index in memory. It starts from a memory-mapped snapshot file (SEARCH_SNAPSHOT)
+    and replays pages updated after the snapshot, including updates made by other processes.
+    """
+
+    def __init__(self):
+        self.__lock = threading.RLock()
+        # Held while replaying updates; MongoDB is queried without self.__lock, so that searches do not wait for it
+        self.__catch_up_lock = threading.Lock()
+        self.__snapshot = None
+        self.__watermark = None
+        self.__dirty = set()
+        self.__terms = {}
+        self.__overlay = {}
+        # page ID -> update date of replayed pages
+        self.__applied = {}
+        # Page IDs known to exist (pages renamed by other processes leave their old IDs behind)
+        self.__verified = set()
+        # Number of add/update calls, and page IDs written by them while updates are replayed
+        self.__writes = 0
+        self.__written = set()
+
+    def __load(self):
+        if self.__snapshot is not None:
+            return
+        snapshot = search_snapshot.load(settings.SEARCH_SNAPSHOT)
+        if snapshot is None:
+            self.rebuild()
+            return
+        self.__snapshot = snapshot
+        self.__watermark = util.millis_to_datetime(snapshot.watermark)
+        self.__dirty = set()
+        self.__terms = {}
+        self.__overlay = {}
+        self.__applied = {}
+        self.__verified = set()
+
+    def __remove(self, pid):
+        self.__dirty.add(pid)
+        for term in self.__terms.pop(pid, []):
+            self.__overlay[term].pop(pid, None)
+
+    def __put(self, pid, title, content):
+        self.__remove(pid)
+        counts = search_index.count_terms(title, content)
+        for term, (tf, cf) in counts.items():
+            self.__overlay.setdefault(term, {})[pid] = tf * 2 + cf
+        self.__terms[pid] = list(counts.keys())
+
+    def __wrote(self, pids):
+        self.__writes += 1
+        if self.__catch_up_lock.locked():
+            self.__written.update(pids)
+
+    def __catch_up(self):
+        from models import pages
+
+        if not self.__catch_up_lock.acquire(blocking=False):
+            # Another thread is replaying; search the updates replayed so far
+            return
+        try:
+            with self.__lock:
+                snapshot = self.__snapshot
+                since = self.__watermark - _CATCH_UP_MARGIN
+                applied = dict(self.__applied)
+                self.__written.clear()
+
+            date = pages.UPDATE + "." + pages.DATE
+            updated = _pages().find({date: {"$gte": since}}, {"_id": False, pages.PAGE_ID: True, pages.UPDATE: True})
+            changed = [
+                page[pages.PAGE_ID] for page in updated
+                if applied.get(page[pages.PAGE_ID]) != page[pages.UPDATE][pages.DATE]
+            ]
+            if len(changed) == 0:
+                return
+            fetched = list(_pages().find(
+                {pages.PAGE_ID: {"$in": changed}},
+                {"_id": False, pages.PAGE_ID: True, pages.TITLE: True, pages.CONTENT: True, pages.UPDATE: True}))
+
+            with self.__lock:
+                if self.__snapshot is not snapshot:
+                    # Rebuilt in the meantime
+                    return
+                for page in fetched:
+                    pid = page[pages.PAGE_ID]
+                    if pid in self.__written:
+                        # Written by this process after the pages were read
+                        continue
+                    if pid not in self.__terms:
+                        # A new or renamed page; the old ID may be left in the snapshot
+                        self.__verified.clear()
+                    self.__put(pid, page[pages.TITLE], page[pages.CONTENT])
+                    self.__applied[pid] = page[pages.UPDATE][pages.DATE]
+                    self.__watermark = max(self.__watermark, page[pages.UPDATE][pages.DATE])
+
+                since = self.__watermark - _CATCH_UP_MARGIN
+                self.__applied = {pid: applied for pid, applied in self.__applied.items() if applied >= since}
+        finally:
+            self.__catch_up_lock.release()
+
+    def __verify(self, results: typing.Dict[str, typing.Dict[str, int]]):
+        # Drop page IDs which no longer exist (renamed by other processes)
+        from models import pages
+
+        with self.__lock:
+            snapshot = self.__snapshot
+            writes = self.__writes
+            unknown = set(pid for points in results.values() for pid in points if pid not in self.__verified)
+        if len(unknown) == 0:
+            return
+        cursor = _pages().find({pages.PAGE_ID: {"$in": list(unknown)}}, {"_id": False, pages.PAGE_ID: True})
+        existing = set(page[pages.PAGE_ID] for page in cursor)
+        missing = unknown - existing
+
+        with self.__lock:
+            if self.__snapshot is snapshot:
+                self.__verified.update(existing)
+                # A page written by this process in the meantime may have taken a missing ID
+                if self.__writes == writes:
+                    for pid in missing:
+                        self.__remove(pid)
+        for points in results.values():
+            for pid in missing:
+                points.pop(pid, None)
+
+    def __fetch(self, terms: typing.List[str]) -> typing.Dict[str, typing.Dict[str, int]]:
+        postings = {}
+        for term in terms:
+            points = {
+                pid: tf * 2 + cf
+                for pid, tf, cf in self.__snapshot.postings(term) if pid not in self.__dirty
+            }
+            points.update(self.__overlay.get(term, {}))
+            postings[term] = points
+        return postings
+
+    def _lookup(self, queries: typing.List[str]) -> typing.Dict[str, typing.Dict[str, int]]:
+        with self.__lock:
+            self.__load()
+        self.__catch_up()
+        with self.__lock:
+            results = search_index.resolve(queries, self.__fetch)
+        self.__verify(results)
+        return results
+
+    def add(self, pid, title, content):
+        with self.__lock:
+            if self.__snapshot is not None:
+                self.__put(pid, title, content)
+                self.__wrote([pid])
+
+    def add_many(self, pages):
+        with self.__lock:
+            if self.__snapshot is not None:
+                pids = []
+                for pid, title, content in pages:
+                    self.__put(pid, title, content)
+                    pids.append(pid)
+                self.__wrote(pids)
+
+    def update(self, old_pid, old_title, old_content, pid, title, content):
+        with self.__lock:
+            if self.__snapshot is not None:
+                self.__remove(old_pid)
+                self.__put(pid, title, content)
+                self.__wrote([old_pid, pid])
+
+    def rebuild(self):
+        from models import pages
+
+        date = pages.UPDATE + "." + pages.DATE
+        latest = _pages().find_one({}, {"_id": False, pages.UPDATE: True}, sort=[(date, pymongo.DESCENDING)])
+        watermark = 0 if latest is None else util.datetime_to_millis(latest[pages.UPDATE][pages.DATE])
+
+        cursor = _pages().find({}, {"_id": False, pages.PAGE_ID: True, pages.TITLE: True, pages.CONTENT: True})
+        search_snapshot.write(
+            settings.SEARCH_SNAPSHOT,
+            watermark,
+            ((p[pages.PAGE_ID], p[pages.TITLE], p[pages.CONTENT]) for p in cursor))
+
+        with self.__lock:
+            if self.__snapshot is not None:
+                self.__snapshot.close()
+                self.__snapshot = None
+            self.__load()
+
+
+class ScanBackend:
+    """Substring count over every page. Slow; kept as the reference of search results."""
+
+    def search(self, and_query, or_query, not_query, offset, n_item) -> Result:
+        from models import pages
+
+        and_query = [q.lower() for q in and_query]
+        or_query = [q.lower() for q in or_query]
+        not_query = [q.lower() for q in not_query]
+
+        def point(title, content, q):
+            return title.count(q) * 2 + content.count(q)
+
+        target = {}
+        titles = {}
+        cursor = _pages().find({}, {"_id": False, pages.PAGE_ID: True, pages.TITLE: True, pages.CONTENT: True})
+        for page in cursor:
+            title = page[pages.TITLE].lower()
+            content = page[pages.CONTENT].lower()
+
+            and_points = [point(title, content, q) for q in and_query]
+            if len(and_points) > 0 and min(and_points) <= 0:
+                and_points = []
+            total = sum(and_points) + sum(point(title, content, q) for q in or_query)
+            if total <= 0:
+                continue
+            if any(point(title, content, q) > 0 for q in not_query):
+                continue
+
+            target[page[pages.PAGE_ID]] = total
+            titles[page[pages.PAGE_ID]] = page[pages.TITLE]
+
+        return _top(target, offset, n_item, titles)
+
+    def add(self, pid, title, content):
+        pass
+
+    def add_many(self, pages):
+        pass
+
+    def update(self, old_pid, old_title, old_content, pid, title, content):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+class TextBackend:
+    """
+    MongoDB text index of pages (title weight 2, content weight 1).
+    Words are split at spaces and punctuation only, so Japanese text needs spaces between words.
+    With AND words, OR words do not change results because $text cannot combine both.
+    """
+
+    @staticmethod
+    def __phrase(q):
+        return '"{}"'.format(q.replace('"', ' '))
+
+    def search(self, and_query, or_query, not_query, offset, n_item) -> Result:
+        from models import pages
+
+        if len(and_query) > 0:
+            words = [self.__phrase(q) for q in and_query]
+        else:
+            words = [q.replace('"', ' ') for q in or_query]
+        if len(words) == 0:
+            return [], 0
+        words += ["-" + self.__phrase(q) for q in not_query]
+
+        query = {"$text": {"$search": " ".join(words)}}
+        count = list(_pages().aggregate([{"$match": query}, {"$count": "count"}]))
+        total = count[0]["count"] if len(count) > 0 else 0
+
+        score = {"$meta": "textScore"}
+        cursor = _pages().find(query, {"_id": False, pages.PAGE_ID: True, pages.TITLE: True, pages.SCORE: score})
+        cursor = cursor.sort([(pages.SCORE, score), (pages.PAGE_ID, pymongo.ASCENDING)]).skip(offset).limit(n_item)
+        return list(cursor), total
+
+    def add(self, pid, title, content):
+        pass
+
+    def add_many(self, pages):
+        pass
+
+    def update(self, old_pid, old_title, old_content, pid, title, content):
+        pass
+
+    def rebuild(self):
+        pass
+
+
+BACKENDS = {
+    "index": IndexBackend,
+    "memory": MemoryBackend,
+    "scan": ScanBackend,
+    "text": TextBackend,
+}
+
+
+def create(name: str):
+    if name not in BACKENDS:
+        raise ValueError("unknown search backend: {}".format(name))
+    return BACKENDS[name]()
+
+
+def parity(
+        queries: typing.List[str],
+        names: typing.List[str],
+        n_item=100) -> typing.List[typing.Tuple[str, str, typing.Set[str], typing.Set[str]]]:
+    # Compare page ids found by each backend with the first one (the reference).
+    # scan matches substrings and the others whole words, so use whole-word queries (see tests/test_search.py).
+    backends = [(name, create(name)) for name in names]
+    differences = []
+    for query in queries:
+        and_query, or_query, not_query = parse_query(query)
+
+        reference = None
+        for name, backend in backends:
+            result, _ = backend.search(and_query, or_query, not_query, 0, n_item)
+            found = set(r["id"] for r in result)
+            if reference is None:
+                reference = found
+            elif found != reference:
+                differences.append((query, name, reference - found, found - reference))
+    return differences
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Maintain search backends of e97")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("rebuild", help="rebuild the index (or snapshot) of the backend set in settings.py")
+    parity_parser = sub.add_parser("parity", help="compare results of backends")
+    parity_parser.add_argument("query", nargs="+")
+    parity_parser.add_argument("--backends", default="scan," + settings.SEARCH_BACKEND,
+                               help="comma separated backends, the first is the reference "
+                                    "(default: scan,SEARCH_BACKEND)")
+    args = parser.parse_args()
+
+    if args.command == "rebuild":
+        create(settings.SEARCH_BACKEND).rebuild()
+        print("OK")
+    elif args.command == "parity":
+        _differences = parity(args.query, args.backends.split(","))
+        for _query, _name, _missing, _extra in _differences:
+            print("{!r} {}: missing {}, extra {}".format(_query, _name, sorted(_missing), sorted(_extra)))
+        print("NG" if len(_differences) > 0 else "OK")
+        sys.exit(1 if len(_differences) > 0 else 0)
+    else:
+        parser.print_help()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import re
+import typing
+from collections import Counter
+
+import pymongo
+
+from models import db
+
+
+def __col(secondary=False):
+    return db.collection("search_index", secondary)
+
+
+TERM = "term"
+PAGE_ID = "page_id"
+TITLE_FREQUENCY = "title"
+CONTENT_FREQUENCY = "content"
+
+"""
+{
+    "term": TERM,
+    "page_id": PAGE_ID,
+    "title": count of TERM in title,
+    "content": count of TERM in content
+}
+"""
+
+# Text without spaces between words (Japanese, Chinese) is indexed as character bigrams.
+_CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff66-\uff9f"
+_TOKEN = re.compile("[{0}]+|[^\\W{0}]+".format(_CJK))
+_CJK_TOKEN = re.compile("[{0}]".format(_CJK))
+
+_BATCH_SIZE = 1000
+
+
+def tokenize(text: str, unigrams=False) -> typing.List[str]:
+    # unigrams: also each character of CJK text, so that a one-character query finds it (indexing)
+    terms = []
+    for token in _TOKEN.findall(text.lower()):
+        if _CJK_TOKEN.match(token) and len(token) > 1:
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+            if unigrams:
+                terms.extend(token)
+        else:
+            terms.append(token)
+    return terms
+
+
+def count_terms(title: str, content: str) -> typing.Dict[str, typing.Tuple[int, int]]:
+    title_terms = Counter(tokenize(title, unigrams=True))
+    content_terms = Counter(tokenize(content, unigrams=True))
+    return {
+        term: (title_terms[term], content_terms[term])
+        for term in title_terms.keys() | content_terms.keys()
+    }
+
+
+def __documents(pid: str, title: str, content: str) -> typing.List[typing.Dict[str, typing.Any]]:
+    return [
+        {
+            TERM: term,
+            PAGE_ID: pid,
+            TITLE_FREQUENCY: tf,
+            CONTENT_FREQUENCY: cf
+        }
+        for term, (tf, cf) in count_terms(title, content).items()
+    ]
+
+
+def add(pid: str, title: str, content: str):
+    documents = __documents(pid, title, content)
+    if len(documents) > 0:
+        __col().insert_many(documents, ordered=False)
+
+
+def remove(pid: str):
+    __col().delete_many({PAGE_ID: pid})
+
+
+def update(old_pid: str, old_title: str, old_content: str, pid: str, title: str, content: str):
+    if old_pid != pid:
+        remove(old_pid)
+        add(pid, title, content)
+        return
+
+    old = count_terms(old_title, old_content)
+    new = count_terms(title, content)
+
+    requests = []
+    removed = [term for term in old.keys() if term not in new]
+    if len(removed) > 0:
+        requests.append(pymongo.DeleteMany({PAGE_ID: pid, TERM: {"$in": removed}}))
+
+    for term, (tf, cf) in new.items():
+        if old.get(term) == (tf, cf):
+            continue
+        requests.append(pymongo.UpdateOne(
+            {TERM: term, PAGE_ID: pid},
+            {"$set": {TITLE_FREQUENCY: tf, CONTENT_FREQUENCY: cf}},
+            upsert=True))
+
+    if len(requests) > 0:
+        __col().bulk_write(requests, ordered=False)
+
+
+def resolve(
+        queries: typing.List[str],
+        fetch: typing.Callable[[typing.List[str]], typing.Dict[str, typing.Dict[str, int]]]) \
+        -> typing.Dict[str, typing.Dict[str, int]]:
+    # A query word which is split into several terms matches pages containing all of them.
+    terms = {q: tokenize(q) for q in queries}
+    all_terms = set(t for ts in terms.values() for t in ts)
+    postings = fetch(list(all_terms)) if len(all_terms) > 0 else {}
+
+    results = {}
+    for q, ts in terms.items():
+        if len(ts) == 0:
+            results[q] = {}
+            continue
+        lists = sorted((postings.get(t, {}) for t in ts), key=len)
+        result = dict(lists[0])
+        for other in lists[1:]:
+            result = {pid: min(point, other[pid]) for pid, point in result.items() if pid in other}
+        results[q] = result
+    return results
+
+
+def __fetch(terms: typing.List[str]) -> typing.Dict[str, typing.Dict[str, int]]:
+    postings = {t: {} for t in terms}
+    for posting in __col(secondary=True).find({TERM: {"$in": terms}}, {"_id": False}):
+        postings[posting[TERM]][posting[PAGE_ID]] = posting[TITLE_FREQUENCY] * 2 + posting[CONTENT_FREQUENCY]
+    return postings
+
+
+def lookup(queries: typing.List[str]) -> typing.Dict[str, typing.Dict[str, int]]:
+    return resolve(queries, __fetch)
+
+
+def add_many(pages: typing.Iterable[typing.Tuple[str, str, str]]):
+    batch = []
+    for pid, title, content in pages:
+        batch.extend(__documents(pid, title, content))
+        if len(batch) >= _BATCH_SIZE:
+            __col().insert_many(batch, ordered=False)
+            batch = []
+    if len(batch) > 0:
+        __col().insert_many(batch, ordered=False)
+
+
+def rebuild(pages: typing.Iterable[typing.Tuple[str, str, str]]):
+    __col().delete_many({})
+    add_many(pages)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import mmap
+import os
+import struct
+import typing
+import uuid
+
+from models import search_index
+
+
+"""
+Snapshot file (little endian)
+    header: b"E97S", version (u32), watermark (i64, milliseconds), number of pages (u32), number of terms (u32)
+    page offsets: u32 * (pages + 1), offsets in page id blob
+    page id blob: UTF-8
+    term offsets: u32 * (terms + 1), offsets in term blob
+    term blob: UTF-8, terms sorted by bytes
+    posting offsets: u32 * (terms + 1), index of the first posting of each term
+    postings: (page index, title count, content count) u32 * 3 for each posting
+"""
+
+_MAGIC = b"E97S"
+# 2: CJK characters are indexed as unigrams too
+_VERSION = 2
+_HEADER = struct.Struct("<4sIqII")
+_POSTING = struct.Struct("<III")
+
+
+def __u32(values: typing.List[int]) -> bytes:
+    return struct.pack("<{}I".format(len(values)), *values)
+
+
+def __blob(strings: typing.List[bytes]) -> typing.Tuple[bytes, bytes]:
+    offsets = [0]
+    for s in strings:
+        offsets.append(offsets[-1] + len(s))
+    return __u32(offsets), b"".join(strings)
+
+
+def write(path: str, watermark: int, pages: typing.Iterable[typing.Tuple[str, str, str]]):
+    pids = []
+    postings = {}
+    for pid, title, content in pages:
+        index = len(pids)
+        pids.append(pid.encode("utf-8"))
+        for term, (tf, cf) in search_index.count_terms(title, content).items():
+            postings.setdefault(term.encode("utf-8"), []).append((index, tf, cf))
+
+    terms = sorted(postings.keys())
+    posting_offsets = [0]
+    for term in terms:
+        posting_offsets.append(posting_offsets[-1] + len(postings[term]))
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = "{}.{}.tmp".format(path, uuid.uuid4())
+    with open(tmp, "wb") as fp:
+        fp.write(_HEADER.pack(_MAGIC, _VERSION, watermark, len(pids), len(terms)))
+        for offsets, blob in (__blob(pids), __blob(terms)):
+            fp.write(offsets)
+            fp.write(blob)
+        fp.write(__u32(posting_offsets))
+        for term in terms:
+            fp.write(b"".join(_POSTING.pack(*posting) for posting in postings[term]))
+    os.replace(tmp, path)
+
+
+class Snapshot:
+    def __init__(self, fp):
+        self.__fp = fp
+        self.__map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.watermark, self.__n_pages, self.__n_terms = _HEADER.unpack_from(self.__map, 0)
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError("not a search snapshot")
+
+        self.__page_offsets = _HEADER.size
+        self.__page_blob = self.__page_offsets + 4 * (self.__n_pages + 1)
+        self.__term_offsets = self.__page_blob + self.__u32(self.__page_offsets, self.__n_pages)
+        self.__term_blob = self.__term_offsets + 4 * (self.__n_terms + 1)
+        self.__posting_offsets = self.__term_blob + self.__u32(self.__term_offsets, self.__n_terms)
+        self.__postings = self.__posting_offsets + 4 * (self.__n_terms + 1)
+
+    def __u32(self, table: int, i: int) -> int:
+        return struct.unpack_from("<I", self.__map, table + 4 * i)[0]
+
+    def __string(self, offsets: int, blob: int, i: int) -> bytes:
+        return self.__map[blob + self.__u32(offsets, i):blob + self.__u32(offsets, i + 1)]
+
+    def __find(self, term: bytes) -> typing.Optional[int]:
+        low, high = 0, self.__n_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self.__string(self.__term_offsets, self.__term_blob, middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.__n_terms and self.__string(self.__term_offsets, self.__term_blob, low) == term:
+            return low
+        return None
+
+    def postings(self, term: str) -> typing.Iterator[typing.Tuple[str, int, int]]:
+        i = self.__find(term.encode("utf-8"))
+        if i is None:
+            return
+        for n in range(self.__u32(self.__posting_offsets, i), self.__u32(self.__posting_offsets, i + 1)):
+            page, tf, cf = _POSTING.unpack_from(self.__map, self.__postings + _POSTING.size * n)
+            yield self.__string(self.__page_offsets, self.__page_blob, page).decode("utf-8"), tf, cf
+
+    def close(self):
+        self.__map.close()
+        self.__fp.close()
+
+
+def load(path: str) -> typing.Optional[Snapshot]:
+    try:
+        fp = open(path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        return Snapshot(fp)
+    except (ValueError, struct.error):
+        fp.close()
+        return None
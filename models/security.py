@@ -18,13 +18,18 @@
 """
 
 import hashlib
+import hmac
 import base64
+import os
 import re
 
+import settings
+
 STRETCH_COUNT = 10000
+SALT_LENGTH = 16
 
 
-def compute_hash(data):
+def __compute_hash_v1(data):
     bytes_ = data.encode(encoding="utf-8")
     salt = [
         base64.b16encode(bytes_).decode(encoding="utf-8"),
@@ -44,6 +49,37 @@ def compute_hash(data):
     return "$1$" + data
 
 
+def __pbkdf2(data, salt, iterations):
+    return hashlib.pbkdf2_hmac("sha512", data.encode(encoding="utf-8"), salt, iterations)
+
+
+def compute_hash(data):
+    # $2$iterations$salt$hash
+    iterations = settings.PASSWORD_HASH_ITERATIONS
+    salt = os.urandom(SALT_LENGTH)
+    return "$2${}${}${}".format(
+        iterations,
+        base64.b64encode(salt).decode(encoding="utf-8"),
+        base64.b64encode(__pbkdf2(data, salt, iterations)).decode(encoding="utf-8"))
+
+
+def verify(data, hash_):
+    ver = version(hash_)
+    if ver == "1":
+        return hmac.compare_digest(__compute_hash_v1(data), hash_)
+    if ver == "2":
+        _, _, iterations, salt, digest = hash_.split("$")
+        computed = __pbkdf2(data, base64.b64decode(salt), int(iterations))
+        return hmac.compare_digest(computed, base64.b64decode(digest))
+    return False
+
+
+def needs_rehash(hash_):
+    if version(hash_) != "2":
+        return True
+    return int(hash_.split("$")[2]) != settings.PASSWORD_HASH_ITERATIONS
+
+
 def version(hash_):
     if hash_ is None:
         return None
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import argparse
+import io
+import itertools
+import json
+import os
+import sys
+import tarfile
+import time
+import typing
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from urllib import parse
+
+import settings
+from core import util
+from models import archive, pages
+
+
+"""
+Pages as reStructuredText files, in a directory or a tar file (.tar, .tar.gz, .tgz, .tar.bz2, .tar.xz)
+
+<page id>.rst
+    .. e97 {"id": ..., "title": ..., "update": {"by": ..., "date": ms}, "create": {...}}
+
+    content
+<page id>.history/<revision>.rst (with --history)
+    .. e97 {"page_id": ..., "archived": ms, "id": ..., "title": ..., "update": {...}, "create": {...}}
+
+    content
+
+"/", "%" and "\\" in page IDs (and "." at the beginning) are written as %XX.
+Files without the first line are imported too: the path without ".rst" is the title.
+"""
+
+HEADER = ".. e97 "
+HISTORY = ".history"
+_BATCH_SIZE = 1000
+
+
+def file_name(pid: str) -> str:
+    name = "".join("%{:02X}".format(ord(c)) if c in "/%\\\0" else c for c in pid)
+    if name.startswith("."):
+        name = "%2E" + name[1:]
+    return name
+
+
+def __dump(header: typing.Dict[str, typing.Any], content: str) -> bytes:
+    return (HEADER + json.dumps(header, ensure_ascii=False) + "\n\n" + content).encode("utf-8")
+
+
+def _load(text: str) -> typing.Tuple[typing.Optional[typing.Dict[str, typing.Any]], str]:
+    if not text.startswith(HEADER):
+        return None, text
+    line, _, content = text.partition("\n")
+    if content.startswith("\n"):
+        content = content[1:]
+    return json.loads(line[len(HEADER):]), content
+
+
+def __dates_to_millis(data: typing.Dict[str, typing.Any]) -> typing.Dict[str, typing.Any]:
+    header = {key: data[key] for key in [pages.PAGE_ID, pages.TITLE] if key in data}
+    for key in [pages.UPDATE, pages.CREATE]:
+        if key in data:
+            header[key] = {pages.BY: data[key][pages.BY], pages.DATE: util.datetime_to_millis(data[key][pages.DATE])}
+    return header
+
+
+def _millis_to_dates(header: typing.Dict[str, typing.Any], author: str) -> typing.Dict[str, typing.Any]:
+    now = datetime.now(timezone.utc)
+    data = {}
+    for key in [pages.UPDATE, pages.CREATE]:
+        if key in header:
+            data[key] = {pages.BY: header[key][pages.BY], pages.DATE: util.millis_to_datetime(header[key][pages.DATE])}
+        else:
+            data[key] = {pages.BY: author, pages.DATE: now}
+    return data
+
+
+class _DirectoryWriter:
+    def __init__(self, path: str):
+        self.__path = path
+
+    def write(self, name: str, data: bytes, mtime: datetime):
+        path = os.path.join(self.__path, *name.split("/"))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        os.utime(path, (mtime.timestamp(), mtime.timestamp()))
+
+    def close(self):
+        pass
+
+
+class _TarWriter:
+    def __init__(self, path: str):
+        compression = ""
+        for extension, name in [(".gz", "gz"), (".tgz", "gz"), (".bz2", "bz2"), (".xz", "xz")]:
+            if path.endswith(extension):
+                compression = name
+        # Stream mode does not seek, so the archive is written as pages are read.
+        self.__tar = tarfile.open(path, "w|" + compression)
+
+    def write(self, name: str, data: bytes, mtime: datetime):
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = mtime.timestamp()
+        self.__tar.addfile(info, io.BytesIO(data))
+
+    def close(self):
+        self.__tar.close()
+
+
+def __is_tar(path: str) -> bool:
+    return any(path.endswith(extension) for extension in [".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz"])
+
+
+def __read(path: str) -> typing.Iterator[typing.Tuple[str, str]]:
+    # (path relative to the root with "/", text) of .rst files, one at a time
+    if __is_tar(path):
+        with tarfile.open(path, "r|*") as tar:
+            for member in tar:
+                if member.isfile() and member.name.endswith(".rst"):
+                    name = member.name[2:] if member.name.startswith("./") else member.name
+                    yield name, tar.extractfile(member).read().decode("utf-8")
+        return
+
+    for root, directories, files in os.walk(path):
+        directories.sort()
+        for name in sorted(files):
+            if name.endswith(".rst"):
+                file_path = os.path.join(root, name)
+                with open(file_path, encoding="utf-8") as fp:
+                    yield os.path.relpath(file_path, path).replace(os.sep, "/"), fp.read()
+
+
+def export(path: str, history=False) -> int:
+    writer = _TarWriter(path) if __is_tar(path) else _DirectoryWriter(path)
+    n_pages = 0
+    try:
+        for page in pages.iterate():
+            name = file_name(page[pages.PAGE_ID])
+            updated = page[pages.UPDATE][pages.DATE]
+            writer.write(name + ".rst", __dump(__dates_to_millis(page), page[pages.CONTENT]), updated)
+            n_pages += 1
+            if not history:
+                continue
+
+            for revision, doc in enumerate(archive.get_by_page(page[pages.PAGE_ID])):
+                data = doc[archive.PAGE_DATA]
+                header = __dates_to_millis(data)
+                header[archive.PAGE_ID] = page[pages.PAGE_ID]
+                header[archive.ARCHIVED_DATE] = util.datetime_to_millis(doc[archive.ARCHIVED_DATE])
+                writer.write("{}{}/{:06d}.rst".format(name, HISTORY, revision),
+                             __dump(header, data[pages.CONTENT]),
+                             doc[archive.ARCHIVED_DATE])
+    finally:
+        writer.close()
+    return n_pages
+
+
+class Importer:
+    """
+    Adds pages in batches of insert_many. Pages whose ID exists are skipped.
+    reST is checked by a process pool; pages with errors are skipped unless allow_errors.
+    """
+
+    def __init__(
+            self,
+            executor: ProcessPoolExecutor,
+            workers: int,
+            author: str,
+            allow_errors=False,
+            batch_size=_BATCH_SIZE):
+        self.__executor = executor
+        self.__chunk_size = max(1, batch_size // (workers * 4))
+        self.__author = author
+        self.__allow_errors = allow_errors
+        self.__batch_size = batch_size
+        self.__pages = []
+        self.__history = []
+        # IDs added by this import; history is added only to them.
+        self.__added = set()
+        self.skipped = []
+        self.errors = []
+
+    @property
+    def n_added(self) -> int:
+        return len(self.__added)
+
+    def put(self, name: str, text: str):
+        directory, _, _ = name.rpartition("/")
+        if directory.endswith(HISTORY):
+            # History follows its page, so pages read so far are added first.
+            self.__flush_pages()
+            self.__history.append(text)
+            if len(self.__history) >= self.__batch_size:
+                self.__flush_history()
+            return
+
+        self.__flush_history()
+        self.__pages.append((name, text))
+        if len(self.__pages) >= self.__batch_size:
+            self.__flush_pages()
+
+    def flush(self):
+        self.__flush_pages()
+        self.__flush_history()
+
+    def __flush_pages(self):
+        if len(self.__pages) == 0:
+            return
+        batch = []
+        for name, text in self.__pages:
+            header, content = _load(text)
+            if header is None:
+                header = {}
+            title = header.get(pages.TITLE, parse.unquote(name[:-len(".rst")]))
+            pid = header.get(pages.PAGE_ID)
+            if pid is None:
+                pid = str(uuid.uuid4()) if settings.SEPARATE_PAGE_TITLE_AND_ID else title
+            datum = {pages.PAGE_ID: pid, pages.TITLE: title, pages.CONTENT: content}
+            datum.update(_millis_to_dates(header, self.__author))
+            batch.append((name, datum))
+        self.__pages = []
+
+        contents = [datum[pages.CONTENT] for _, datum in batch]
+        data = []
+        for (name, datum), errors in zip(batch, self.__executor.map(util.rest_errors, contents,
+                                                                    chunksize=self.__chunk_size)):
+            if len(errors) > 0:
+                self.errors.append((name, errors))
+                if not self.__allow_errors:
+                    continue
+            data.append(datum)
+
+        added = pages.add_many(data)
+        self.__added.update(added)
+        if len(added) < len(data):
+            added = set(added)
+            self.skipped.extend(datum[pages.PAGE_ID] for datum in data if datum[pages.PAGE_ID] not in added)
+
+    def __flush_history(self):
+        if len(self.__history) == 0:
+            return
+        revisions = []
+        for text in self.__history:
+            header, content = _load(text)
+            pid = header[archive.PAGE_ID]
+            if pid not in self.__added:
+                continue
+            datum = {pages.PAGE_ID: header[pages.PAGE_ID], pages.TITLE: header[pages.TITLE], pages.CONTENT: content}
+            datum.update(_millis_to_dates(header, self.__author))
+            revisions.append((pid, util.millis_to_datetime(header[archive.ARCHIVED_DATE]), datum))
+        self.__history = []
+
+        for pid, group in itertools.groupby(revisions, key=lambda revision: revision[0]):
+            archive.add_many(pid, ((date, datum) for _, date, datum in group))
+
+
+def import_(path: str, author: str, workers: typing.Optional[int]=None, allow_errors=False) -> Importer:
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        importer = Importer(executor, workers, author, allow_errors)
+        for name, text in __read(path):
+            importer.put(name, text)
+        importer.flush()
+
+    if settings.SEARCH_BACKEND == "memory":
+        # Imported pages may be older than the snapshot.
+        pages.rebuild_search_index()
+    return importer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import or export pages of e97 as reStructuredText files")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export", help="write all pages to a directory or a tar file")
+    export_parser.add_argument("path", help="directory, or tar file (.tar, .tar.gz, ...)")
+    export_parser.add_argument("--history", action="store_true", help="also write archived revisions")
+
+    import_parser = subparsers.add_parser("import", help="add pages from a directory or a tar file")
+    import_parser.add_argument("path", help="directory, or tar file (.tar, .tar.gz, ...)")
+    import_parser.add_argument("--author", default="System", help="user ID of pages without the header line")
+    import_parser.add_argument("--workers", type=int, help="processes to check reST (default: number of CPUs)")
+    import_parser.add_argument("--allow-errors", action="store_true", help="add pages with reST errors too")
+
+    args = parser.parse_args()
+    _start = time.monotonic()
+
+    if args.command == "export":
+        print("exported {} pages".format(export(args.path, args.history)))
+    else:
+        _importer = import_(args.path, args.author, args.workers, args.allow_errors)
+        for _name, _errors in _importer.errors:
+            for _error in _errors:
+                print("{}: {}".format(_name, _error), file=sys.stderr)
+        print("added {} pages, skipped {} existing pages, {} pages with reST errors{}".format(
+            _importer.n_added, len(_importer.skipped), len(_importer.errors),
+            "" if args.allow_errors else " (not added)"))
+    print("{:.1f} seconds".format(time.monotonic() - _start))
@@ -20,14 +20,16 @@
 import typing
 import getpass
 
-import pymongo
+import settings
+from core import cache
+from models import db, security
 
-from models import security
 
+def __col():
+    return db.collection("users")
 
-__client = pymongo.MongoClient(tz_aware=True)
-__db = __client["e97"]
-__col = __db["users"]
+
+__name_cache = cache.TTLCache(1024, settings.USER_NAME_CACHE_TTL)
 
 
 USER_ID = "id"
@@ -56,7 +58,7 @@ def add(uid: str, name: str, pw: str, level: str) -> bool:
     if security.version(pw) is None:
         pw = security.compute_hash(pw)
 
-    __col.insert_one({
+    __col().insert_one({
         USER_ID: uid,
         NAME: name,
         PASSWORD: pw,
@@ -66,11 +68,17 @@ def add(uid: str, name: str, pw: str, level: str) -> bool:
 
 
 def remove(uid: str):
-    __col.delete_one({USER_ID: uid})
+    __col().delete_one({USER_ID: uid})
+    __name_cache.pop(uid)
 
 
 def get(uid: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
-    return __col.find_one({USER_ID: uid}, {"_id": False})
+    return __col().find_one({USER_ID: uid}, {"_id": False})
+
+
+def get_many(uids: typing.Iterable[str]) -> typing.Dict[str, typing.Dict[str, typing.Any]]:
+    cursor = __col().find({USER_ID: {"$in": list(set(uids))}}, {"_id": False, PASSWORD: False})
+    return {ui[USER_ID]: ui for ui in cursor}
 
 
 def update(uid: str, pw: typing.Optional[str]=None, level: typing.Optional[str]=None):
@@ -84,25 +92,43 @@ def update(uid: str, pw: typing.Optional[str]=None, level: typing.Optional[str]=
     if level is not None:
         query[LEVEL] = level
 
-    __col.update_one({USER_ID: uid}, {"$set": query})
+    __col().update_one({USER_ID: uid}, {"$set": query})
 
 
 def check(uid: str, pw: str) -> bool:
-    if security.version(pw) is None:
-        pw = security.compute_hash(pw)
-
     ui = get(uid)
     if ui is None:
         return False
 
-    return ui[PASSWORD] == pw
+    if not security.verify(pw, ui[PASSWORD]):
+        return False
+
+    if security.needs_rehash(ui[PASSWORD]):
+        __col().update_one({USER_ID: uid, PASSWORD: ui[PASSWORD]}, {"$set": {PASSWORD: security.compute_hash(pw)}})
+    return True
+
+
+def to_names(uids: typing.Iterable[str]) -> typing.Dict[str, str]:
+    names = {}
+    missing = []
+    for uid in set(uids):
+        name = __name_cache.get(uid)
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+
+    if len(missing) > 0:
+        found = get_many(missing)
+        for uid in missing:
+            name = found[uid][NAME] if uid in found else uid
+            __name_cache.put(uid, name)
+            names[uid] = name
+    return names
 
 
 def to_name(uid: str):
-    ui = get(uid)
-    if ui is None:
-        return uid
-    return ui[NAME]
+    return to_names([uid])[uid]
 
 
 if __name__ == '__main__':
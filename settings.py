@@ -18,8 +18,63 @@
 """
 
 
+MONGO_URI = "mongodb://localhost:27017"
+MONGO_DATABASE = "e97"
+MONGO_MAX_POOL_SIZE = 100
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = None
+# Read preference of reads which may lag behind writes (search, index, history).
+# e.g. "secondaryPreferred" to serve them from replica set secondaries
+MONGO_READ_PREFERENCE = "primary"
+
+# Secret key to sign session cookies. Set the same value on every process and host.
+# If None, a random key is generated on each start and sessions only work in a single process.
+SECRET_KEY = None
+# "memory" (single process) or "mongo" (shared by all processes)
+SESSION_STORE = "memory"
+
+# PBKDF2-HMAC-SHA512 iterations of password hash. Stored hashes are updated on the next login when changed.
+PASSWORD_HASH_ITERATIONS = 10000
+
 SEPARATE_PAGE_TITLE_AND_ID = False
 SAVE_TO_ARCHIVE = True
+# Archive stores a full copy every this number of revisions and compressed differences in between
+ARCHIVE_KEYFRAME_INTERVAL = 16
+# Refuse to start when MongoDB indexes are missing (unique indexes are always required)
+REQUIRE_INDEXES = False
+# "index" (inverted index), "memory" (inverted index in memory), "text" (MongoDB text index)
+# or "scan" (reads every page; for reference only)
+SEARCH_BACKEND = "index"
+SEARCH_SNAPSHOT = "cache/search.snapshot"
 
 TOP_PAGE_REST = "rest/top_page.rst"
 ERROR_PAGE_DIRECTORY = "rest/error"
+
+RENDER_CACHE_SIZE = 256
+LATEST_CACHE_TTL = 10
+USER_NAME_CACHE_TTL = 60
+
+PDF_CACHE_DIRECTORY = "cache/pdf"
+# PDF files not used for this many seconds are removed, and the least recently used ones
+# while the directory is larger than this many bytes
+PDF_CACHE_TTL = 7 * 86400
+PDF_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+# Number of wkhtmltopdf processes run at the same time, and requests allowed to wait for them
+PDF_WORKERS = 2
+PDF_QUEUE_SIZE = 8
+PDF_TIMEOUT = 120
+
+# Serve request and MongoDB statistics at /metrics (Prometheus text format)
+METRICS_ENABLED = False
+# Bearer token required by /metrics (None: served to anyone, as it does not need login)
+METRICS_TOKEN = None
+# Add Server-Timing header (time spent in MongoDB, rendering, ...) to responses
+METRICS_SERVER_TIMING = False
+
+# Batch PDF export (/export): where files are written, processes rendering pages of a job,
+# maximum number of pages of a job and seconds to keep jobs and their files
+EXPORT_DIRECTORY = "cache/export"
+EXPORT_PROCESSES = 2
+EXPORT_MAX_PAGES = 5000
+EXPORT_TTL = 86400
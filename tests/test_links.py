@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import unittest
+
+from core import util
+
+
+class RelatedTargetsTest(unittest.TestCase):
+    def test_rendered(self):
+        self.assertEqual(util.related_targets("text\n\n.. related:: A\n\n* .. related:: B\n\n.. RELATED:: A\n"),
+                         ["A", "B"])
+
+    def test_not_rendered(self):
+        # Pages documenting the directive must not link to its examples
+        for content in ["Example::\n\n    .. related:: X\n",
+                        ".. code-block:: rst\n\n    .. related:: X\n",
+                        "..\n   .. related:: X\n",
+                        "The related:: directive\n"]:
+            self.assertEqual(util.related_targets(content), [], content)
+
+    def test_substitution(self):
+        content = ".. |a| related:: A\n\nsee |a|\n\n.. |b| related:: B\n"
+        self.assertEqual(util.related_targets(content), ["A"])
+
+
+if __name__ == '__main__':
+    unittest.main()
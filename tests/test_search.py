@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+  Copyright 2018 SiLeader.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+try:
+    import mongomock
+except ImportError:
+    mongomock = None
+
+import settings
+from models import db, pages, schema, search
+
+
+# (id, title, content)
+CORPUS = [
+    ("setup", "Server setup", "How to set up the web server. Install python and flask."),
+    ("database", "Database", "MongoDB database settings. The server stores pages."),
+    ("cache", "Cache", "Render cache and database cache keep pages in memory."),
+    ("tips", "Python", "python flask tips"),
+    ("japanese", "Japanese", "全文検索の設定"),
+]
+
+# Whole words: every backend finds the same pages.
+AGREED = [
+    "server",
+    "database cache",
+    "pages -cache",
+    "flask",
+    "python -tips",
+    "memory",
+    "missing",
+]
+
+# Intended differences: query -> backend -> page ids
+DIFFERENCES = {
+    # scan matches parts of words, the others whole words only
+    "data": {"scan": {"database", "cache"}, "index": set(), "memory": set(), "text": set()},
+    "serv": {"scan": {"setup", "database"}, "index": set(), "memory": set(), "text": set()},
+    # Text without spaces is matched by bigrams (one character: unigrams) except in the text index,
+    # which splits words at spaces and punctuation only
+    "検索": {"scan": {"japanese"}, "index": {"japanese"}, "memory": {"japanese"}, "text": set()},
+    "検": {"scan": {"japanese"}, "index": {"japanese"}, "memory": {"japanese"}, "text": set()},
+}
+
+
+def _found(name: str, query: str):
+    and_query, or_query, not_query = search.parse_query(query)
+    result, total = search.create(name).search(and_query, or_query, not_query, 0, 100)
+    found = set(r[pages.PAGE_ID] for r in result)
+    assert total == len(found), (name, query, total, found)
+    return found
+
+
+class _Parity:
+    backends = []
+
+    def setUp(self):
+        self.__directory = tempfile.mkdtemp()
+        self.__settings = (settings.MONGO_DATABASE, settings.SEARCH_SNAPSHOT)
+        settings.MONGO_DATABASE = "e97_test"
+        settings.SEARCH_SNAPSHOT = os.path.join(self.__directory, "search.snapshot")
+        self.connect()
+        db.get_client().drop_database(settings.MONGO_DATABASE)
+
+        date = datetime(2018, 1, 1, tzinfo=timezone.utc)
+        db.collection("pages").insert_many([
+            {
+                pages.PAGE_ID: pid,
+                pages.TITLE: title,
+                pages.CONTENT: content,
+                pages.UPDATE: {pages.BY: "test", pages.DATE: date},
+                pages.CREATE: {pages.BY: "test", pages.DATE: date},
+            }
+            for pid, title, content in CORPUS
+        ])
+        self.prepare()
+
+    def tearDown(self):
+        db.get_client().drop_database(settings.MONGO_DATABASE)
+        db.reset()
+        settings.MONGO_DATABASE, settings.SEARCH_SNAPSHOT = self.__settings
+        shutil.rmtree(self.__directory)
+
+    def connect(self):
+        raise NotImplementedError
+
+    def prepare(self):
+        pass
+
+    def test_agreed(self):
+        self.assertEqual(search.parity(AGREED, ["scan"] + self.backends), [])
+
+    def test_differences(self):
+        for query, expected in DIFFERENCES.items():
+            for name in ["scan"] + self.backends:
+                self.assertEqual(_found(name, query), expected[name], (query, name))
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class IndexParityTest(_Parity, unittest.TestCase):
+    backends = ["index", "memory"]
+
+    def connect(self):
+        db.set_client(mongomock.MongoClient(tz_aware=True))
+
+    def prepare(self):
+        search.create("index").rebuild()
+
+
+@unittest.skipIf(mongomock is None, "mongomock is not installed")
+class MemoryCatchUpTest(IndexParityTest):
+    # Pages written by other processes (directly to the collection)
+    backends = ["memory"]
+
+    def __page(self, pid: str, content: str, date: datetime):
+        db.collection("pages").insert_one({
+            pages.PAGE_ID: pid,
+            pages.TITLE: pid,
+            pages.CONTENT: content,
+            pages.UPDATE: {pages.BY: "test", pages.DATE: date},
+            pages.CREATE: {pages.BY: "test", pages.DATE: date},
+        })
+
+    def test_late_commit(self):
+        backend = search.create("memory")
+        now = datetime.now(timezone.utc)
+        self.__page("newer", "zebra", now)
+        self.assertEqual(backend.search(["zebra"], [], [], 0, 10)[1], 1)
+        # Dated before "newer", but written after it was replayed
+        self.__page("older", "zebra", now - timedelta(seconds=10))
+        self.assertEqual(backend.search(["zebra"], [], [], 0, 10)[1], 2)
+
+    def test_renamed(self):
+        backend = search.create("memory")
+        self.assertEqual(backend.search(["server"], [], [], 0, 10)[1], 2)
+        db.collection("pages").delete_one({pages.PAGE_ID: "setup"})
+        self.__page("setup2", "How to set up the web server.", datetime.now(timezone.utc))
+        result, total = backend.search(["server"], [], [], 0, 10)
+        self.assertEqual((set(r[pages.PAGE_ID] for r in result), total), ({"database", "setup2"}, 2))
+
+
+@unittest.skipIf("E97_TEST_MONGO_URI" not in os.environ, "E97_TEST_MONGO_URI is not set (mongomock has no $text)")
+class TextParityTest(_Parity, unittest.TestCase):
+    backends = ["text"]
+
+    def connect(self):
+        self.__uri = settings.MONGO_URI
+        settings.MONGO_URI = os.environ["E97_TEST_MONGO_URI"]
+        db.reset()
+
+    def prepare(self):
+        db.collection("pages").create_indexes([schema.TEXT_INDEX])
+
+    def tearDown(self):
+        super().tearDown()
+        settings.MONGO_URI = self.__uri
+
+
+if __name__ == '__main__':
+    unittest.main()